@@ -1,42 +1,83 @@
-import collections
+import time
+import itertools
 
 
-def bounded_submitter(task, size, args_iter):
-    results = collections.deque()
+def unordered_submitter(task, size, args_iter, poll_interval=0.2):
+    """
+    Submits the tasks for each set of arguments in `args_iter` while keeping
+    at most `size` of them running, and yields ``(args, result, duration)``
+    tuples in completion order, so that a slow task never blocks the
+    collection of the ones submitted after it.
 
-    for i in range(size):
-        try:
-            args = next(args_iter)
-        except StopIteration:
-            break
-        else:
-            results.append(task.delay(*args))
+    The next arguments are only pulled from `args_iter` when a slot frees
+    up, so that they can be computed lazily.
+    """
+    pending = {}
 
-    while results:
-        res = results.popleft().get()
+    def submit():
         try:
             args = next(args_iter)
         except StopIteration:
+            return False
+        pending[task.delay(*args)] = (args, time.time())
+        return True
+
+    for i in range(size):
+        if not submit():
             break
-        else:
-            results.append(task.delay(*args))
-        finally:
-            yield res
 
-    while results:
-        res = results.popleft().get()
-        yield res
+    while pending:
+        ready = [result for result in pending if result.ready()]
+        if not ready:
+            time.sleep(poll_interval)
+            continue
+        for result in ready:
+            args, submitted_at = pending.pop(result)
+            res = result.get()
+            duration = time.time() - submitted_at
+            submit()
+            yield args, res, duration
+
+
+class AdaptiveChunker(object):
+    """
+    Splits an iterable in chunks whose size is continuously adjusted so that
+    processing a single chunk takes about `target_duration` seconds, based
+    on the per-item latency reported through `record`.
+    """
+
+    def __init__(self, size, target_duration, min_size=1, max_size=None,
+                 smoothing=0.3):
+        self.size = size
+        self.target_duration = target_duration
+        self.min_size = min_size
+        self.max_size = max_size
+        self.smoothing = smoothing
+        self.item_duration = None
 
+    def record(self, count, duration):
+        if not count:
+            return
+        sample = duration / count
+        if self.item_duration is None:
+            self.item_duration = sample
+        else:
+            self.item_duration = (
+                self.smoothing * sample +
+                (1 - self.smoothing) * self.item_duration
+            )
+        if self.item_duration:
+            size = int(self.target_duration / self.item_duration)
+        else:
+            size = self.max_size or self.size
+        if self.max_size is not None:
+            size = min(size, self.max_size)
+        self.size = max(size, self.min_size)
 
-def iter_chunks(iterable, size):
-    iterable = iter(iterable)
-    while True:
-        res = []
-        for i in range(size):
-            try:
-                res.append(next(iterable))
-            except StopIteration:
+    def iter_chunks(self, iterable):
+        iterable = iter(iterable)
+        while True:
+            res = list(itertools.islice(iterable, self.size))
+            if not res:
                 break
-        if not res:
-            break
-        yield res
+            yield res
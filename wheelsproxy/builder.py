@@ -1,4 +1,5 @@
 import os
+import re
 import json
 import zipfile
 import contextlib
@@ -6,17 +7,32 @@ from tempfile import mkdtemp
 import shutil
 import hashlib
 import io
+from email.parser import HeaderParser
 
 from six.moves import shlex_quote
 
 import furl
 
+from pkg_resources import safe_extra
+from pkg_resources.extern.packaging.requirements import (
+    InvalidRequirement,
+    Requirement,
+)
+
 from docker import Client, tls
 
 from django.conf import settings
 from django.core.files import File
 from django.utils import timezone
 
+from . import client
+
+# Matches the value compared to the ``extra`` marker variable, on either side
+EXTRA_MARKER_RE = re.compile(
+    r"""(\bextra\s*[=!]=\s*)(["'])([^"']*)\2"""
+    r"""|(["'])([^"']*)\4(\s*[=!]=\s*extra\b)"""
+)
+
 
 @contextlib.contextmanager
 def tempdir(*args, **kwargs):
@@ -84,6 +100,127 @@ def extract_wheel_meta(fh):
             return None
 
 
+def extract_wheel_metadata_file(fh):
+    """
+    Returns the raw content of the ``.dist-info/METADATA`` file of the given
+    wheel, as served to clients supporting PEP 658.
+    """
+    with zipfile.ZipFile(fh) as z:
+        for member in z.infolist():
+            try:
+                dirname, basename = member.filename.split("/")
+            except ValueError:
+                continue
+            if dirname.endswith(".dist-info") and basename == "METADATA":
+                return z.read(member.filename)
+        else:
+            return None
+
+
+def normalize_extra_marker(marker):
+    """
+    Rewrites the extra names compared in the given marker with
+    ``safe_extra``, as done for the requested extras, so that
+    ``extra == "Tests"`` applies when the ``tests`` extra is requested.
+    """
+
+    def normalize(match):
+        if match.group(1):
+            quote = match.group(2)
+            return match.group(1) + quote + safe_extra(match.group(3)) + quote
+        quote = match.group(4)
+        return quote + safe_extra(match.group(5)) + quote + match.group(6)
+
+    return EXTRA_MARKER_RE.sub(normalize, marker)
+
+
+def parse_wheel_metadata(content):
+    """
+    Parses the content of a ``METADATA`` file (PEP 566) into the structure
+    stored on ``Build.metadata``. Requirement markers are split off, so that
+    resolving the dependencies of a build does not require to parse each
+    requirement again, and the extra names in them are normalized.
+    """
+    message = HeaderParser().parsestr(content.decode("utf-8", "replace"))
+    requires_dist = []
+    for spec in message.get_all("Requires-Dist") or []:
+        try:
+            requirement = Requirement(spec)
+        except InvalidRequirement:
+            continue
+        marker = None
+        if requirement.marker:
+            marker = normalize_extra_marker(str(requirement.marker))
+        requirement.marker = None
+        requires_dist.append([str(requirement), marker])
+    return {
+        "metadata_version": message.get("Metadata-Version"),
+        "requires_python": message.get("Requires-Python"),
+        "provides_extra": [
+            safe_extra(extra)
+            for extra in message.get_all("Provides-Extra") or []
+        ],
+        "requires_dist": requires_dist,
+    }
+
+
+def store_wheel(build, filename, fh):
+    """
+    Saves the given wheel as the file of the build along with its metadata.
+    The ``md5_digest`` of the build has to be set by the caller.
+    """
+    metadata_file = extract_wheel_metadata_file(fh)
+    fh.seek(0)
+    if metadata_file is not None:
+        build.metadata = parse_wheel_metadata(metadata_file)
+    else:
+        build.metadata = extract_wheel_meta(fh)
+        fh.seek(0)
+    build.build.save(filename, File(fh))
+    build.filesize = build.build.size
+    build.save_metadata_file(metadata_file)
+    build.save()
+
+
+def mirror_wheel(build, session=None, chunk_size=64 * 1024):
+    """
+    Stores the original wheel of the given build as-is, instead of building
+    it, as wheels installable on any platform (``none-any``) would come out
+    of ``pip wheel`` unchanged. The digest is verified while downloading.
+    """
+    url = build.original_url
+    filename = os.path.basename(furl.furl(url).path.segments[-1])
+    session = session if session is not None else client.get_files_session()
+
+    build_start = timezone.now()
+    with tempdir(dir=settings.TEMP_BUILD_ROOT) as workdir:
+        path = os.path.join(workdir, filename)
+        md5 = hashlib.md5()
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            with open(path, "wb") as fh:
+                for chunk in response.iter_content(chunk_size):
+                    md5.update(chunk)
+                    fh.write(chunk)
+
+        expected_digest = build.original_md5_digest
+        if expected_digest and md5.hexdigest() != expected_digest:
+            raise RuntimeError(
+                "MD5 digest mismatch for {}: expected {}, got {}".format(
+                    url, expected_digest, md5.hexdigest()
+                )
+            )
+
+        build.build_log = "Mirrored {}\n".format(url)
+        build.build_timestamp = timezone.now()
+        build.build_duration = (
+            build.build_timestamp - build_start
+        ).total_seconds()
+        build.md5_digest = md5.hexdigest()
+        with open(path, "rb") as fh:
+            store_wheel(build, filename, fh)
+
+
 class DockerBuilder(object):
     def __init__(self, platform_spec):
         self.image = platform_spec["image"]
@@ -193,14 +330,9 @@ class DockerBuilder(object):
                 filename = filenames[0]
 
                 with open(os.path.join(wheelhouse, filename), "rb") as fh:
-                    build.metadata = extract_wheel_meta(fh)
-                    fh.seek(0)
                     build.md5_digest = file_digest(hashlib.md5, fh)
                     fh.seek(0)
-                    build.build.save(filename, File(fh))
-                    fh.seek(0)
-                    build.filesize = build.build.size
-                    build.save()
+                    store_wheel(build, filename, fh)
             else:
                 raise RuntimeError("Build failed")
 
@@ -225,6 +357,14 @@ class DockerBuilder(object):
             with open(os.path.join(workspace, "requirements.in"), "w") as fh:
                 fh.write(reqs.requirements)
 
+            compiled_requirements = os.path.join(workspace, "requirements.txt")
+            previous = reqs.previous
+            if previous is not None and previous.is_compiled():
+                # pip-compile keeps the pins of an existing output file as
+                # long as they still satisfy the requirements.
+                with open(compiled_requirements, "w") as fh:
+                    fh.write(previous.pip_compiled_requirements)
+
             image, tag = split_image_name(self.image)
             consume_output(
                 self.client.pull(image, tag, stream=True), compilation_log
@@ -259,6 +399,7 @@ class DockerBuilder(object):
                 ),
                 compilation_log,
             )
+            exit_code = self.client.wait(container=container["Id"])
 
             self.client.remove_container(container=container["Id"], v=True)
 
@@ -276,9 +417,8 @@ class DockerBuilder(object):
                 ]
             )
 
-            compiled_requirements = os.path.join(workspace, "requirements.txt")
-
-            if os.path.exists(compiled_requirements):
+            # The output file may be the seeded one if the compilation failed
+            if exit_code == 0 and os.path.exists(compiled_requirements):
                 with open(compiled_requirements, "r") as fh:
                     reqs.pip_compiled_requirements = fh.read()
                     reqs.pip_compilation_status = COMPILATION_STATUSES.DONE
@@ -1,7 +1,12 @@
 import logging
 import time
-from collections import namedtuple
+import threading
+import itertools
+import contextlib
+from collections import namedtuple, defaultdict, deque
+from concurrent import futures
 import io
+import json
 
 import six
 import requests
@@ -16,10 +21,29 @@ from .utils import retry_call, exponential_backoff
 log = logging.getLogger(__name__)
 
 
+DEVPI_STREAMING_CHANGES = 'application/x-devpi-replica-changes'
+
+
 class PackageNotFound(Exception):
     pass
 
 
+class NotModified(Exception):
+    """
+    Raised when the releases of a package did not change since the
+    response identified by the validators passed along with the request.
+    """
+
+
+class PackageReleases(dict):
+    """
+    A mapping of versions to releases, optionally carrying the cache
+    validators (``etag``, ``last_modified`` and ``size``) of the response
+    it was built from.
+    """
+    validators = None
+
+
 class Release(namedtuple('Release', ['url', 'md5_digest', 'type'])):
     @staticmethod
     def guess_type(url):
@@ -48,9 +72,190 @@ class Release(namedtuple('Release', ['url', 'md5_digest', 'type'])):
         raise ValueError('Cannot guess package type of `{}`'.format(url))
 
 
+class IndexSession(requests.Session):
+    """
+    A session keeping a pool of persistent connections to each host, which
+    applies a default timeout to every request and never runs more than
+    `max_connections` concurrent requests against the same host.
+    """
+
+    def __init__(self, timeout=None, max_connections=None):
+        super(IndexSession, self).__init__()
+        if timeout is None:
+            timeout = settings.INDEX_REQUEST_TIMEOUT
+        if max_connections is None:
+            max_connections = settings.INDEX_MAX_CONNECTIONS
+        self.timeout = timeout
+        self.max_connections = max_connections
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_connections,
+            pool_maxsize=max_connections,
+        )
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+        self._host_limits = defaultdict(
+            lambda: threading.BoundedSemaphore(max_connections))
+        self._host_limits_lock = threading.Lock()
+
+    def _host_limit(self, url):
+        with self._host_limits_lock:
+            return self._host_limits[furl.furl(url).netloc]
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        with self._host_limit(url):
+            return super(IndexSession, self).request(method, url, **kwargs)
+
+
+class RangeRequestsNotSupported(IOError):
+    """
+    Raised when the server does not honour the ``Range`` header of a
+    request made by `RemoteFile`.
+    """
+
+
+class RemoteFile(io.RawIOBase):
+    """
+    A read-only, seekable file-like object on top of the given URL, which
+    only downloads the bytes actually read, using HTTP range requests.
+
+    Reads are rounded up to `block_size` bytes and the fetched blocks are
+    kept around, so that the many small reads ``zipfile`` does when opening
+    an archive only require a couple of requests. The last block is fetched
+    straight away, as it holds the central directory of zip files.
+    """
+
+    def __init__(self, url, session=None, block_size=64 * 1024):
+        super(RemoteFile, self).__init__()
+        self.url = url
+        self.session = session if session is not None else get_files_session()
+        self.block_size = block_size
+        self.requests_count = 0
+        self._pos = 0
+        self._blocks = []
+
+        response = self._fetch('bytes=-{}'.format(block_size))
+        try:
+            self.size = int(response.headers['Content-Range'].split('/')[1])
+        except (KeyError, IndexError, ValueError):
+            raise RangeRequestsNotSupported(url)
+        self._blocks.append((self.size - len(response.content),
+                             response.content))
+
+    def _fetch(self, byte_range):
+        response = self.session.get(self.url, stream=True, headers={
+            'Range': byte_range,
+            'Accept-Encoding': 'identity',
+        })
+        self.requests_count += 1
+        if response.status_code != 206:
+            response.close()
+            response.raise_for_status()
+            raise RangeRequestsNotSupported(self.url)
+        return response
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError('Invalid whence ({})'.format(whence))
+        if pos < 0:
+            raise ValueError('Negative seek position {}'.format(pos))
+        self._pos = pos
+        return pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        start = self._pos
+        end = min(start + size, self.size)
+        if end <= start:
+            return b''
+
+        for offset, data in self._blocks:
+            if offset <= start and end <= offset + len(data):
+                break
+        else:
+            fetch_end = min(max(end, start + self.block_size), self.size)
+            response = self._fetch('bytes={}-{}'.format(start, fetch_end - 1))
+            offset, data = start, response.content
+            if len(data) < end - start:
+                raise IOError('Short read from {}'.format(self.url))
+            self._blocks.append((offset, data))
+
+        self._pos = end
+        return data[start - offset:end - offset]
+
+
+_files_session = None
+
+
+def get_files_session():
+    """
+    Returns the session shared by the requests made to download release
+    files, so that connections to the file hosts are reused.
+    """
+    global _files_session
+    if _files_session is None:
+        _files_session = IndexSession()
+    return _files_session
+
+
 class IndexAPIClient(object):
+    # Number of response bytes avoided thanks to conditional requests
+    bytes_saved = 0
+
     def __init__(self, url):
         self.url = url
+        self._bytes_saved_lock = threading.Lock()
+
+    def add_bytes_saved(self, size):
+        # Conditional requests are made from several threads at once
+        with self._bytes_saved_lock:
+            self.bytes_saved += size
+
+    def iter_package_releases(self, package_names, validators=None):
+        """
+        Fetches the releases of multiple packages concurrently, yielding a
+        ``(package_name, releases, error)`` tuple as soon as each of them
+        is available.
+
+        `validators` optionally maps package names to the validators of
+        their last fetched releases, see `get_package_releases`.
+        """
+        validators = validators or {}
+        executor = futures.ThreadPoolExecutor(
+            max_workers=settings.INDEX_MAX_CONNECTIONS,
+        )
+        with executor:
+            pending = {}
+            for package_name in package_names:
+                future = executor.submit(
+                    self.get_package_releases,
+                    package_name,
+                    validators=validators.get(package_name),
+                )
+                pending[future] = package_name
+            for future in futures.as_completed(pending):
+                try:
+                    releases = future.result()
+                except Exception as e:
+                    yield pending[future], None, e
+                else:
+                    yield pending[future], releases, None
 
     def changelog_last_serial(self):
         raise NotImplementedError
@@ -61,7 +266,8 @@ class IndexAPIClient(object):
     def iter_updated_packages(self, since_serial):
         raise NotImplementedError
 
-    def get_package_releases(self, package_name, ensure_serial=None):
+    def get_package_releases(self, package_name, ensure_serial=None,
+                             validators=None):
         raise NotImplementedError
 
     def get_version_releases(self, package_name, version):
@@ -72,7 +278,7 @@ class PyPIClient(IndexAPIClient):
     def __init__(self, model):
         super(PyPIClient, self).__init__(model)
         self.client = xmlrpc_client.ServerProxy(self.url)
-        self.session = requests.Session()
+        self.session = IndexSession()
 
     def changelog_last_serial(self):
         return self.client.changelog_last_serial()
@@ -95,20 +301,41 @@ class PyPIClient(IndexAPIClient):
                     yield package_name, event_serial
             events = self.client.changelog_since_serial(event_serial)
 
-    def _clean_releases(self, version_details):
-        return [Release(
-            rel['url'],
-            rel['md5_digest'],
-            rel['packagetype'],
-        ) for rel in version_details]
+    @staticmethod
+    def _releases_object_hook(obj):
+        # Called by the decoder for each JSON object, innermost first: file
+        # entries are replaced by compact Release tuples as soon as they are
+        # parsed and the package info is dropped, so that only the releases
+        # mapping is fully materialized.
+        if 'packagetype' in obj and 'url' in obj:
+            return Release(obj['url'], obj['md5_digest'], obj['packagetype'])
+        if 'releases' in obj and 'info' in obj:
+            return obj['releases']
+        if 'description' in obj and 'classifiers' in obj:
+            return None
+        return obj
 
-    def _request_package_releases(self, package_name):
+    def _decode_releases(self, content):
+        return json.loads(
+            content.decode('utf-8'),
+            object_hook=self._releases_object_hook,
+        )
+
+    def _request_package_releases(self, package_name, validators=None):
         url = furl.furl(self.url)
         url.path.add([package_name, 'json'])
 
-        response = self.session.get(url)
+        headers = {}
+        if validators and validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators and validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.session.get(url, headers=headers)
         if response.status_code == 404:
             raise PackageNotFound()
+        if response.status_code == 304 and headers:
+            return response
         if response.status_code >= 300:
             content = response.content
             log.warning('Invalid response {} from index {} with content: {!r}'
@@ -117,37 +344,136 @@ class PyPIClient(IndexAPIClient):
                                .format(response.status_code))
         return response
 
-    def get_package_releases(self, package_name, ensure_serial=None):
-        for i in range(settings.MAX_CACHE_BUSTING_RETRIES + 1):
-            response = self._request_package_releases(package_name)
+    def get_package_releases(self, package_name, ensure_serial=None,
+                             validators=None):
+        request_validators = validators
+        retries = 0
+        while True:
+            response = self._request_package_releases(
+                package_name,
+                request_validators,
+            )
             if ensure_serial is None:
                 break
 
-            serial = int(response.headers.get('X-PyPI-Last-Serial'))
+            serial = response.headers.get('X-PyPI-Last-Serial')
+            if (serial is None and response.status_code == 304 and
+                    request_validators):
+                # A 304 without serial may come from a stale CDN node and
+                # does not tell whether the document is up to date: fetch
+                # it again unconditionally (not counted as a retry).
+                request_validators = None
+                continue
+
+            serial = int(serial)
             if serial >= ensure_serial:
                 # The response is up to date, we can process it...
                 break
 
+            if retries >= settings.MAX_CACHE_BUSTING_RETRIES:
+                raise RuntimeError((
+                    'Could not bust stale package cache for {} '
+                    '(should be at least at {}, is at {})'
+                ).format(package_name, ensure_serial, serial))
+
             # The response is stale (probably cached by an upstream
             # CDN), wait some time and retry...
-            time.sleep(exponential_backoff(i))
+            time.sleep(exponential_backoff(retries))
+            retries += 1
+
+        if response.status_code == 304:
+            size = validators.get('size') or 0
+            self.add_bytes_saved(size)
+            log.debug('{} not modified on {}, saved {} bytes'
+                      .format(package_name, self.url, size))
+            raise NotModified()
+
+        releases = PackageReleases(self._decode_releases(response.content))
+        releases.validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'size': len(response.content),
+        }
+        return releases
+
+
+class PyPISimpleClient(PyPIClient):
+    """
+    A PyPI client which tracks changes through the ``_last-serial`` of each
+    project in the PEP 691 JSON simple index instead of XML-RPC.
+
+    Projects which disappeared from the index are detected by diffing the
+    listing against a snapshot of the previous one. The snapshot is kept by
+    `snapshot_store`, an object with ``load_snapshot()`` and
+    ``store_snapshot(snapshot)`` methods (the backing index), or in memory
+    if none is set.
+    """
+    SIMPLE_JSON = 'application/vnd.pypi.simple.v1+json'
+
+    def __init__(self, url, snapshot_store=None):
+        super(PyPISimpleClient, self).__init__(url)
+        self.snapshot_store = snapshot_store
+        self._snapshot = None
+
+    def load_snapshot(self):
+        if self.snapshot_store is not None:
+            return self.snapshot_store.load_snapshot()
+        return self._snapshot
+
+    def store_snapshot(self, snapshot):
+        if self.snapshot_store is not None:
+            self.snapshot_store.store_snapshot(snapshot)
         else:
-            raise RuntimeError((
-                'Could not bust stale package cache for {} '
-                '(should be at least at {}, is at {})'
-            ).format(package_name, ensure_serial, serial))
-
-        releases = response.json()['releases']
-        return {
-            k: self._clean_releases(v)
-            for k, v in six.iteritems(releases)
+            self._snapshot = snapshot
+
+    @property
+    def simple_url(self):
+        url = furl.furl(self.url)
+        url.path.set(url.path.segments[:-1] + ['simple', ''])
+        return url
+
+    def _get_simple_index(self):
+        response = self.session.get(self.simple_url, headers={
+            'Accept': self.SIMPLE_JSON,
+        })
+        response.raise_for_status()
+        return response.json()
+
+    def changelog_last_serial(self):
+        return self._get_simple_index()['meta']['_last-serial']
+
+    def list_packages(self):
+        return [p['name'] for p in self._get_simple_index()['projects']]
+
+    def iter_updated_packages(self, since_serial):
+        previous = self.load_snapshot() or {}
+        current = {
+            project['name']: project['_last-serial']
+            for project in self._get_simple_index()['projects']
         }
 
+        for package_name in previous.keys() - current.keys():
+            # The project was removed, the import will fail and remove it
+            # without advancing the serial.
+            yield package_name, since_serial
+
+        changed = sorted(
+            (serial, package_name)
+            for package_name, serial in six.iteritems(current)
+            if serial > since_serial
+        )
+        for serial, package_name in changed:
+            yield package_name, serial
+
+        self.store_snapshot(current)
+
 
 class DevPIClient(IndexAPIClient):
+    supports_changelog_ranges = True
+
     def __init__(self, model):
         super(DevPIClient, self).__init__(model)
-        self.api_session = requests.Session()
+        self.api_session = IndexSession()
         self.api_session.headers.update({
             'Accept': 'application/json',
         })
@@ -197,7 +523,8 @@ class DevPIClient(IndexAPIClient):
             type,
         ) for rel, type in releases if type]
 
-    def get_package_releases(self, package_name, ensure_serial=None):
+    def get_package_releases(self, package_name, ensure_serial=None,
+                             validators=None):
         url = furl.furl(self.url)
         url.path.add(package_name)
 
@@ -215,12 +542,145 @@ class DevPIClient(IndexAPIClient):
         return {k: self._clean_releases(v) for k, v in six.iteritems(releases)}
 
     def _load_payload(self, payload):
-        payload = io.BytesIO(payload)
+        if isinstance(payload, bytes):
+            payload = io.BytesIO(payload)
         return (
             Unserializer(payload, strconfig=(False, False))
             .load(versioned=False)
         )
 
+    def _iter_payloads(self, stream):
+        """
+        Decodes consecutive payloads from `stream` as they are read, until
+        the end of the stream is reached.
+        """
+        while True:
+            try:
+                payload = self._load_payload(stream)
+            except EOFError:
+                return
+            yield payload
+
+    def _fetch_changelog_event(self, changelog_url, serial, headers):
+        url = changelog_url.copy()
+        url.path.add(str(serial))
+        response = retry_call(3, self.api_session.get,
+                              url, timeout=15, headers=headers)
+        response.raise_for_status()
+        return self._load_payload(response.content)[0]
+
+    def _fetch_changelog_range(self, changelog_url, start, headers):
+        """
+        Requests all the changelog entries starting at `start` at once
+        through the ``+changelog/<start>-`` endpoint of newer devpi-server
+        versions. Returns ``None`` if the server does not support it.
+        """
+        url = changelog_url.copy()
+        url.path.add('{}-'.format(start))
+        headers = dict(headers, Accept=', '.join([
+            DEVPI_STREAMING_CHANGES,
+            'application/octet-stream;q=0.9',
+        ]))
+        response = retry_call(3, self.api_session.get,
+                              url, timeout=15, headers=headers, stream=True)
+        if response.status_code == 404:
+            response.close()
+            return None
+        response.raise_for_status()
+        return response
+
+    def _iter_changelog_range(self, response):
+        with contextlib.closing(response):
+            response.raw.decode_content = True
+            stream = io.BufferedReader(response.raw, buffer_size=65536)
+            content_type = response.headers.get('content-type', '')
+            if content_type.startswith(DEVPI_STREAMING_CHANGES):
+                # A stream of alternating serials and raw changelog entries,
+                # which are (changes, renames) tuples.
+                payloads = self._iter_payloads(stream)
+                for serial, entry in zip(payloads, payloads):
+                    yield serial, entry[0]
+            else:
+                # A single list of (serial, changes) tuples, limited in size
+                # by the server. devpi-server already unpacks the changes
+                # out of the entries here, but full entries are accepted as
+                # well.
+                for serial, event in self._load_payload(stream):
+                    if isinstance(event, (tuple, list)):
+                        event = event[0]
+                    yield serial, event
+
+    def _iter_changelog_ranges(self, changelog_url, start, end, headers):
+        while start <= end:
+            response = self._fetch_changelog_range(
+                changelog_url, start, headers)
+            if response is None:
+                log.info('{} does not support changelog ranges, falling back '
+                         'to per-serial requests'.format(self.url))
+                self.supports_changelog_ranges = False
+                break
+            first = start
+            for serial, event in self._iter_changelog_range(response):
+                if serial > end:
+                    break
+                yield serial, event
+                start = serial + 1
+            if start == first:
+                # The server did not return anything for this range
+                break
+
+        if start <= end:
+            yield from self._iter_changelog_window(
+                changelog_url, start, end, headers)
+
+    def _iter_changelog_window(self, changelog_url, start, end, headers):
+        """
+        Yields the ``(serial, event)`` tuples from `start` to `end`
+        (inclusive) in serial order, while keeping a sliding window of
+        DEVPI_CHANGELOG_WINDOW requests in flight.
+        """
+        window = settings.DEVPI_CHANGELOG_WINDOW
+        serials = iter(range(start, end + 1))
+        pending = deque()
+
+        def submit(count):
+            for serial in itertools.islice(serials, count):
+                pending.append((serial, executor.submit(
+                    self._fetch_changelog_event,
+                    changelog_url,
+                    serial,
+                    headers,
+                )))
+
+        with futures.ThreadPoolExecutor(max_workers=window) as executor:
+            submit(window)
+            while pending:
+                serial, future = pending.popleft()
+                event = future.result()
+                submit(1)
+                yield serial, event
+
+    def _iter_changelog(self, changelog_url, start, end, headers):
+        if self.supports_changelog_ranges:
+            events = self._iter_changelog_ranges(
+                changelog_url, start, end, headers)
+        else:
+            events = self._iter_changelog_window(
+                changelog_url, start, end, headers)
+
+        fetched = 0
+        started = time.time()
+        try:
+            for serial, event in events:
+                fetched += 1
+                yield serial, event
+        finally:
+            elapsed = time.time() - started
+            log.info('Fetched {} changelog events from {} in {:.1f}s '
+                     '({:.1f} events/s)'.format(
+                         fetched, self.url, elapsed,
+                         fetched / elapsed if elapsed else 0))
+
     def iter_updated_packages(self, since_serial):
         changelog_url = furl.furl(self.url)
         changelog_url.path.set(changelog_url.path.segments[:-2])
@@ -235,14 +695,13 @@ class DevPIClient(IndexAPIClient):
 
         while since_serial < current_serial:
             seen_packages = set()
-            for event_serial in range(since_serial + 1, current_serial + 1):
-                url = changelog_url.copy()
-                url.path.add(str(event_serial))
-                response = retry_call(3, self.api_session.get,
-                                      url, timeout=15, headers=headers)
-                response.raise_for_status()
-
-                event = self._load_payload(response.content)[0]
+            events = self._iter_changelog(
+                changelog_url,
+                since_serial + 1,
+                current_serial,
+                headers,
+            )
+            for event_serial, event in events:
                 for k, v in event.items():
                     event_type, backserial, value = v
                     method_name = 'handle_{}'.format(event_type.upper())
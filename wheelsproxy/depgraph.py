@@ -1,4 +1,5 @@
 import io
+import functools
 import itertools
 import collections
 import textwrap
@@ -7,13 +8,12 @@ import furl
 
 import attr
 
+from django.conf import settings
 from django.core.exceptions import ObjectDoesNotExist
+from django.utils.module_loading import import_string
 
 from pkg_resources import Requirement, parse_version
 from pkg_resources.extern.packaging.specifiers import SpecifierSet
-from pkg_resources.extern.packaging.requirements import (
-    Requirement as BaseRequirement,
-)
 
 from . import utils
 
@@ -38,7 +38,21 @@ class IncompatibleRequirements(CompilationFailed):
     requirements = attr.ib(convert=tuple)
 
 
+@functools.lru_cache(maxsize=65536)
+def requirement_contains(req, version):
+    """
+    Memoized ``version in req``. Requirements hash on their parsed content,
+    so that equal requirements share their results.
+    """
+    return version in req
+
+
+@functools.lru_cache(maxsize=16384)
 def merge_requirements(*reqs):
+    """
+    Merges the given requirements on a single package. The result is shared
+    between the callers and must not be modified.
+    """
     assert reqs
 
     key = reqs[0].key
@@ -54,29 +68,51 @@ def merge_requirements(*reqs):
             assert url is None or url == req.url
             url = req.url
             spec = str(furl.furl(url).fragment.args['egg'])
-            req = Requirement.parse(spec)
+            req = utils.parse_requirement_spec(spec)
             assert req.key == key
 
-        specifier &= SpecifierSet(str(req.specifier))
-        extras |= set(req.extras)
-
-    req = BaseRequirement(key)
-    req.extras = extras
-    req.specifier = specifier
-    req.marker = None
-    req.url = None
+        specifier &= req.specifier
+        extras.update(req.extras)
 
-    req = Requirement.parse(str(req))
+    req = utils.parse_requirement_spec('{}{}{}'.format(
+        key,
+        '[{}]'.format(','.join(sorted(extras))) if extras else '',
+        specifier,
+    ))
 
     if url:
         key, version = str(furl.furl(url).fragment.args['egg']).split('==')
-        if parse_version(version) not in req:
+        if not requirement_contains(req, parse_version(version)):
             raise IncompatibleRequirements(reqs)
-        req = Requirement.parse('{}@{}'.format(key, url))
+        req = utils.parse_requirement_spec('{}@{}'.format(key, url))
 
     return req
 
 
+def prefer_version(versions, preferred):
+    """
+    Moves the given preferred version, if any, to the front of the given
+    ``(version, release)`` tuples.
+    """
+    if preferred is None:
+        return versions
+    return sorted(versions, key=lambda v: v[0] != preferred)
+
+
+def select_best_release(req, versions, preferred=None):
+    """
+    Returns the release of the newest of the given ``(version, release)``
+    tuples, sorted newest first, which satisfies the requirement. The
+    `preferred` version is returned instead if it satisfies it as well.
+    """
+    for version, release in prefer_version(versions, preferred):
+        # TODO .is_prerelease is too naive, if req is ==
+        if not version.is_prerelease and requirement_contains(req, version):
+            return release
+    else:
+        raise UnsatisfiedDependency(req, [v[0] for v in reversed(versions)])
+
+
 def find_best_release(indexes, req):
     versions = []
 
@@ -87,12 +123,9 @@ def find_best_release(indexes, req):
             continue
         versions.extend(package.get_versions())
 
-    for version, release in sorted(versions, reverse=True, key=lambda v: v[0]):
-        # TODO .is_prerelease is too naive, if req is ==
-        if not version.is_prerelease and version in req:
-            return release
-    else:
-        raise UnsatisfiedDependency(req, [v[0] for v in sorted(versions)])
+    # The sort is stable: releases of earlier indexes win on equal versions
+    versions.sort(reverse=True, key=lambda v: v[0])
+    return select_best_release(req, versions)
 
 
 @attr.s(slots=True)
@@ -147,6 +180,18 @@ class DependencyGraph(object):
 
     _nodes = attr.ib(init=False, default=attr.Factory(collections.OrderedDict))
     _log = attr.ib(init=False, default=attr.Factory(io.StringIO))
+    _candidates = attr.ib(init=False, default=attr.Factory(dict))
+    # Maps package names to the versions to keep if they are still
+    # compatible, e.g. the ones of a previous compilation.
+    _preferred = attr.ib(init=False, default=attr.Factory(dict))
+    # Maps the name of each package to the names of the packages required by
+    # any of its builds, and lists the packages whose selected build changed
+    # since the orphaned requirements were last removed.
+    _dependents = attr.ib(
+        init=False,
+        default=attr.Factory(lambda: collections.defaultdict(set)),
+    )
+    _changed = attr.ib(init=False, default=attr.Factory(list))
 
     def add_requirement(self, req):
         if req.marker:
@@ -159,6 +204,9 @@ class DependencyGraph(object):
 
     def update_requirement(self, req, *, required_by):
         key = utils.normalize_package_name(req.key)
+        if required_by:
+            parent_key = utils.normalize_package_name(required_by.package_name)
+            self._dependents[parent_key].add(key)
         if key in self._nodes:
             return self._nodes[key].merge_requirements(
                 req, required_by=required_by, clear_build=True)
@@ -179,7 +227,7 @@ class DependencyGraph(object):
 
     def __contains__(self, req):
         if isinstance(req, str):
-            req = Requirement.parse(req)
+            req = utils.parse_requirement_spec(req)
         if not isinstance(req, Requirement):
             return False
         key = utils.normalize_package_name(req.key)
@@ -192,16 +240,24 @@ class DependencyGraph(object):
             # No build was selected yet
             return True
 
-        return node.build.release.parsed_version in req
+        return requirement_contains(req, node.build.release.parsed_version)
 
     def _remove_node(self, node):
         key = utils.normalize_package_name(node.package_name)
         del self._nodes[key]
+        self._changed.append(key)
+
+    def _set_build(self, node, build):
+        node.build = build
+        self._changed.append(utils.normalize_package_name(node.package_name))
+
+    def _ensure_metadata(self, build):
+        if not build.is_built() and not build.fetch_metadata():
+            # print('Building', build)
+            build.rebuild()
 
     def _add_requirements(self, node):
-        if not node.build.is_built():
-            # print('Building', node.build)
-            node.build.rebuild()
+        self._ensure_metadata(node.build)
 
         tainted = False
 
@@ -215,65 +271,125 @@ class DependencyGraph(object):
 
     def _contains_build(self, build):
         if build.is_external():
-            return Requirement.parse('{}@{}'.format(
+            return utils.parse_requirement_spec('{}@{}'.format(
                 build.package_name,
                 build.external_url,
             ))
         else:
             return build.release.requirement in self
 
-    def _remove_round(self):
+    def _remove_dependents(self, key):
+        """
+        Drops the edges from the builds of the given package which are not
+        selected anymore and removes the packages left without any.
+        """
         removed = False
 
-        for node in list(self._nodes.values()):
+        for child_key in list(self._dependents.get(key, ())):
+            node = self._nodes.get(child_key)
+            if node is None:
+                self._dependents[key].discard(child_key)
+                continue
             required_by = [
                 build for build in node.required_by
                 if self._contains_build(build)
             ]
+            if len(required_by) == len(node.required_by):
+                continue
+            node.required_by = required_by
             if not node.declared and not required_by:
                 self._log.write('removing {}\n'.format(node))
                 self._remove_node(node)
                 removed = True
-            elif len(required_by) != len(node.required_by):
-                node.required_by = required_by
+
+        if key not in self._nodes:
+            self._dependents.pop(key, None)
 
         return removed
 
+    def _load_candidates(self, package_names):
+        """
+        Loads the candidate releases of the given packages which were not
+        loaded yet, with a single query for each index.
+        """
+        missing = {
+            utils.normalize_package_name(package_name)
+            for package_name in package_names
+        }.difference(self._candidates)
+        if not missing:
+            return
+
+        for key in missing:
+            self._candidates[key] = []
+        for index in self.indexes:
+            for key, versions in index.get_candidates(missing).items():
+                self._candidates[key].extend(versions)
+        for key in missing:
+            # The sort is stable: releases of earlier indexes win on equal
+            # versions
+            self._candidates[key].sort(reverse=True, key=lambda v: v[0])
+
+    def _select_release(self, node):
+        key = utils.normalize_package_name(node.package_name)
+        try:
+            return select_best_release(
+                node.requirement,
+                self._candidates[key],
+                self._preferred.get(key),
+            )
+        except UnsatisfiedDependency as e:
+            self._log.write(
+                'Could not find a version that matches {}\n'
+                .format(e.requirement)
+            )
+            self._log.write(textwrap.fill('Tried: {}\n'.format(
+                ', '.join([str(v) for v in e.versions])
+            )))
+            raise
+        except IncompatibleRequirements as e:
+            self._log.write(
+                'Cannot merge incompatible requirements:\n'
+            )
+            self._log.write(
+                '\n'.join([str(v) for v in e.requirements])
+            )
+            raise
+
     def _compile_round(self):
         tainted = False
 
         self._log.write('Adding new dependencies:\n')
 
-        for node in list(self._nodes.values()):
-            if node.build is not None:
-                continue
+        pending = [
+            node for node in self._nodes.values()
+            if node.build is None
+        ]
+        self._load_candidates(
+            node.package_name for node in pending
+            if not node.requirement.url
+        )
+
+        selected = []
+        for node in pending:
             if node.requirement.url:
-                node.build = self.platform.get_external_build(
+                self._set_build(node, self.platform.get_external_build(
                     node.requirement.url,
-                )
+                ))
             else:
-                try:
-                    node.build = find_best_release(
-                        self.indexes,
-                        node.requirement,
-                    ).get_build(self.platform)
-                except UnsatisfiedDependency as e:
-                    self._log.write(
-                        'Could not find a version that matches {}\n'
-                        .format(e.requirement)
-                    )
-                    self._log.write(textwrap.fill('Tried: {}\n'.format(
-                        ', '.join([str(v) for v in e.versions])
-                    )))
-                    raise
-                except IncompatibleRequirements as e:
-                    self._log.write(
-                        'Cannot merge incompatible requirements:\n'
-                    )
-                    self._log.write(
-                        '\n'.join([str(v) for v in e.requirements])
-                    )
-                    raise
+                selected.append((node, self._select_release(node)))
+
+        builds = self.platform.get_builds([
+            release for node, release in selected
+        ])
+        for (node, release), build in zip(selected, builds):
+            self._set_build(node, build)
+
+        for node in pending:
+            if node.build is None:
+                # The requirements of the node were changed by a node
+                # processed earlier in this round, the build is selected
+                # again in the next round.
+                continue
             tainted |= self._add_requirements(node)
 
         return tainted
@@ -281,22 +397,38 @@ class DependencyGraph(object):
     def remove_orphaned_requirements(self):
         tainted = False
 
-        for round in itertools.count(1):
-            if not self._remove_round():
-                break
-            tainted = True
+        # Only the packages whose selected build changed or which were
+        # removed can leave other packages orphaned.
+        while self._changed:
+            tainted |= self._remove_dependents(self._changed.pop())
 
         return tainted
 
-    def compile(self, requirements):
+    def _reset(self, preferred=None):
+        self._preferred = {
+            utils.normalize_package_name(package_name): parse_version(
+                str(version))
+            for package_name, version in (preferred or {}).items()
+        }
         self._nodes = collections.OrderedDict()
         self._log = io.StringIO()
+        self._candidates = {}
+        self._dependents = collections.defaultdict(set)
+        self._changed = []
 
         self._log.write('Using indexes:\n')
         for index in self.indexes:
             self._log.write(' - {}: {}\n'.format(index.slug, index.url))
         self._log.write('\n')
 
+    def compile(self, requirements, preferred=None):
+        """
+        Resolves the given requirements. `preferred` optionally maps package
+        names to the versions to select when they are compatible, so that
+        recompiling slightly changed requirements keeps the other pins.
+        """
+        self._reset(preferred)
+
         for req in utils.parse_requirements(requirements):
             self.add_requirement(req)
 
@@ -332,6 +464,296 @@ class DependencyGraph(object):
         return self._log.getvalue()
 
 
+class ResolutionConflict(Exception):
+    """
+    Raised internally by `BacktrackingDependencyGraph` when pinning a release
+    leads to unsatisfiable requirements. `causes` holds the names of the
+    packages whose pins are responsible for the conflict.
+    """
+
+    def __init__(self, requirement, causes):
+        super(ResolutionConflict, self).__init__(requirement, causes)
+        self.requirement = requirement
+        self.causes = frozenset(causes)
+
+
+@attr.s(frozen=True)
+class Criterion(object):
+    """
+    The merged requirement on a package, along with the
+    ``(requirement, parent_name, parent_build)`` tuples it was merged from
+    and the versions excluded by the conflicts found so far.
+    """
+    requirement = attr.ib()
+    information = attr.ib(convert=tuple)
+    excluded = attr.ib(convert=frozenset, default=frozenset())
+
+    @property
+    def parents(self):
+        return {parent for _, parent, _ in self.information if parent}
+
+    @property
+    def declared(self):
+        return any(parent is None for _, parent, _ in self.information)
+
+    def iter_candidates(self, versions):
+        if self.requirement.url:
+            if None not in self.excluded:
+                yield None, self.requirement.url
+            return
+        for version, release in versions:
+            # TODO .is_prerelease is too naive, if req is ==
+            if version.is_prerelease or version in self.excluded:
+                continue
+            if requirement_contains(self.requirement, version):
+                yield version, release
+
+    def is_satisfied_by(self, version):
+        if self.requirement.url or version is None:
+            return bool(self.requirement.url) and version is None
+        return requirement_contains(self.requirement, version)
+
+    def merge(self, req, parent, parent_build):
+        return Criterion(
+            merge_requirements(self.requirement, req),
+            self.information + ((req, parent, parent_build),),
+            self.excluded,
+        )
+
+
+@attr.s
+class ResolutionState(object):
+    # Maps package names to the pinned ``(version, build)`` tuples
+    mapping = attr.ib()
+    # Maps package names to their `Criterion`
+    criteria = attr.ib()
+    # Maps package names to the packages whose pins are known to conflict
+    # with some of their versions
+    conflicts = attr.ib()
+
+    def copy(self):
+        return ResolutionState(
+            collections.OrderedDict(self.mapping),
+            collections.OrderedDict(self.criteria),
+            dict(self.conflicts),
+        )
+
+
+@attr.s
+class BacktrackingDependencyGraph(DependencyGraph):
+    """
+    Resolves the requirements by pinning one package at a time, propagating
+    the requirements of each pinned release right away and backjumping to
+    the most recent pin responsible for a conflict instead of failing when
+    the newest release of a package is not compatible.
+
+    The result is exposed through the same nodes as `DependencyGraph`, so
+    that it can be formatted with `GraphFormatter`.
+
+    Every release pinned while exploring needs its metadata, so sdists
+    which can't be inspected remotely are built even if the resolution
+    later backtracks over them. This is why this engine has to be enabled
+    explicitly through the ``DEPENDENCY_RESOLVER`` setting.
+    """
+    max_steps = attr.ib(default=20000)
+
+    _state = attr.ib(init=False, default=None)
+    _builds = attr.ib(init=False, default=attr.Factory(dict))
+
+    def _get_build(self, name, version, candidate):
+        if version is None:
+            return self.platform.get_external_build(candidate)
+        try:
+            return self._builds[id(candidate)]
+        except KeyError:
+            build = self.platform.get_builds([candidate])[0]
+            self._builds[id(candidate)] = build
+            return build
+
+    def _add_constraint(self, state, req, parent, parent_build):
+        name = utils.normalize_package_name(req.key)
+        criterion = state.criteria.get(name)
+        if criterion is None:
+            previous_extras = set()
+            criterion = Criterion(
+                Requirement.parse(str(req)),
+                [(req, parent, parent_build)],
+            )
+        else:
+            previous_extras = set(criterion.requirement.extras)
+            try:
+                criterion = criterion.merge(req, parent, parent_build)
+            except IncompatibleRequirements:
+                raise ResolutionConflict(req, criterion.parents | {
+                    parent, name,
+                })
+        state.criteria[name] = criterion
+
+        causes = (criterion.parents | state.conflicts.get(name, set())
+                  | {name})
+        if name in state.mapping:
+            version, build = state.mapping[name]
+            if not criterion.is_satisfied_by(version):
+                raise ResolutionConflict(criterion.requirement, causes)
+            if set(criterion.requirement.extras) - previous_extras:
+                # The requirements of the additional extras of an already
+                # pinned release have to be added as well.
+                self._add_dependencies(state, name, build)
+        else:
+            self._load_candidates([name])
+            if not any(criterion.iter_candidates(self._candidates[name])):
+                raise ResolutionConflict(criterion.requirement, causes)
+
+    def _add_dependencies(self, state, name, build):
+        self._ensure_metadata(build)
+        requirements = list(build.iter_requirements(
+            state.criteria[name].requirement.extras,
+        ))
+        self._load_candidates([
+            req.key for req in requirements if not req.url
+        ])
+        for req in requirements:
+            self._add_constraint(state, req, name, build)
+
+    def _pin(self, state, name, version, candidate):
+        build = self._get_build(name, version, candidate)
+        state = state.copy()
+        state.mapping[name] = (version, build)
+        self._add_dependencies(state, name, build)
+        return state
+
+    def _next_name(self, state):
+        unpinned = [
+            name for name in state.criteria
+            if name not in state.mapping
+        ]
+        if not unpinned:
+            return None
+        # Fail first: the packages with a single candidate left are pinned
+        # before the others, as they can't be backtracked over anyway.
+        return min(unpinned, key=lambda name: len(list(itertools.islice(
+            state.criteria[name].iter_candidates(
+                self._candidates.get(name, [])),
+            2,
+        ))))
+
+    def _backjump(self, decisions, name, causes):
+        """
+        Pops the decisions until the most recent one responsible for the
+        conflict and returns the state preceding it with the conflicting
+        version excluded.
+        """
+        causes = set(causes) - {name}
+        while decisions:
+            state, decided_name, version = decisions.pop()
+            if decided_name not in causes:
+                continue
+            self._log.write('backtracking to {} ({})\n'.format(
+                decided_name, version or 'url'))
+            state = state.copy()
+            criterion = state.criteria[decided_name]
+            state.criteria[decided_name] = attr.evolve(
+                criterion, excluded=criterion.excluded | {version})
+            state.conflicts[decided_name] = (
+                state.conflicts.get(decided_name, set())
+                | causes) - {decided_name}
+            return state
+
+        criterion = self._state.criteria[name]
+        self._log.write(
+            'Could not find a version that matches {}\n'
+            .format(criterion.requirement)
+        )
+        versions = [v[0] for v in reversed(self._candidates.get(name, []))]
+        self._log.write(textwrap.fill('Tried: {}\n'.format(
+            ', '.join([str(v) for v in versions])
+        )))
+        raise UnsatisfiedDependency(criterion.requirement, versions)
+
+    def compile(self, requirements, preferred=None):
+        self._reset(preferred)
+        self._builds = {}
+
+        self._state = ResolutionState(
+            collections.OrderedDict(), collections.OrderedDict(), {})
+        declared = []
+        for req in utils.parse_requirements(requirements):
+            if req.marker:
+                if not req.marker.evaluate(self.platform.environment):
+                    continue
+                req.marker = None
+                req = Requirement.parse(str(req))
+            declared.append(req)
+        self._load_candidates([req.key for req in declared if not req.url])
+        try:
+            for req in declared:
+                self._add_constraint(self._state, req, None, None)
+        except ResolutionConflict as e:
+            self._log.write('Conflicting requirements on {}\n'.format(
+                e.requirement))
+            raise UnsatisfiedDependency(e.requirement, [])
+
+        decisions = []
+        for step in itertools.count(1):
+            if step > self.max_steps:
+                self._log.write('Giving up after {} steps\n'.format(step))
+                raise CompilationFailed('Resolution too complex')
+
+            name = self._next_name(self._state)
+            if name is None:
+                break
+
+            criterion = self._state.criteria[name]
+            causes = criterion.parents | self._state.conflicts.get(name, set())
+            candidates = prefer_version(
+                criterion.iter_candidates(self._candidates.get(name, [])),
+                self._preferred.get(name),
+            )
+            for version, candidate in candidates:
+                try:
+                    state = self._pin(self._state, name, version, candidate)
+                except ResolutionConflict as e:
+                    self._log.write('  {} {} conflicts on {}\n'.format(
+                        name, version or 'url', e.requirement))
+                    causes |= e.causes
+                    continue
+                self._log.write('pinning {} {}\n'.format(
+                    name, version or candidate))
+                decisions.append((self._state, name, version))
+                self._state = state
+                break
+            else:
+                self._state = self._backjump(decisions, name, causes)
+
+        self._log.write(
+            '--------------------------------------------\n'
+            'Resolved {} packages in {} steps\n\n'
+            .format(len(self._state.mapping), step - 1)
+        )
+
+        for name, criterion in self._state.criteria.items():
+            version, build = self._state.mapping[name]
+            required_by = []
+            for _, parent, parent_build in criterion.information:
+                if parent and parent_build not in required_by:
+                    required_by.append(parent_build)
+            self._nodes[name] = DependencyNode(
+                criterion.requirement,
+                build=build,
+                declared=criterion.declared,
+                required_by=required_by,
+            )
+
+        return self._log.getvalue()
+
+
+def get_graph_class():
+    """
+    Returns the dependency graph class configured to compile requirements.
+    """
+    return import_string(settings.DEPENDENCY_RESOLVER)
+
+
 @attr.s
 class GraphFormatter(object):
     show_parents = attr.ib(default=27)
@@ -0,0 +1,70 @@
+import time
+
+import djclick as click
+
+from django.core.cache import cache
+
+from ... import pages
+from ...models import Package
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[int(round(p / 100 * (len(timings) - 1)))]
+
+
+def measure(lookup, count):
+    timings = []
+    for i in range(count):
+        start = time.perf_counter()
+        lookup()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+@click.command()
+@click.option('--requests', 'count', type=int, default=1000,
+              help='Number of lookups to time for each scheme.')
+@click.argument('index_slugs')
+@click.argument('platform_slug')
+@click.argument('package_name')
+def command(count, index_slugs, platform_slug, package_name):
+    """
+    Compares the latency of the simple page lookups, resolving the versioned
+    key with a separate round-trip, in a single one, or validating the
+    per-process cache.
+    """
+    index_slugs = index_slugs.split('+')
+
+    def two_round_trips():
+        return cache.get(Package.get_cache_key(
+            pages.PAGES_NAMESPACE, index_slugs, platform_slug, package_name,
+        ))
+
+    def single_round_trip():
+        return pages.get_page(index_slugs, platform_slug, package_name,
+                              local_cache=None)
+
+    def local_cache():
+        return pages.get_page(index_slugs, platform_slug, package_name)
+
+    if single_round_trip()[1] is None:
+        click.secho('The page of {} is not cached, request it at least once '
+                    'before running the benchmark.'.format(package_name),
+                    fg='yellow')
+
+    for name, lookup in [
+            ('two round-trips', two_round_trips),
+            ('single round-trip', single_round_trip),
+            ('local cache', local_cache)]:
+        timings = measure(lookup, count)
+        click.echo('{:<20} p50: {:.3f}ms  p99: {:.3f}ms'.format(
+            name,
+            percentile(timings, 50) * 1000,
+            percentile(timings, 99) * 1000,
+        ))
+
+    click.echo('local cache stats: {}'.format(', '.join(
+        '{}={}'.format(k, v)
+        for k, v in sorted(pages.local_cache.stats().items())
+    )))
@@ -2,7 +2,7 @@ import djclick as click
 from djclick.params import ModelInstance
 
 from ...models import BackingIndex, Platform
-from ...depgraph import DependencyGraph, GraphFormatter
+from ...depgraph import GraphFormatter, get_graph_class
 
 
 @click.command()
@@ -12,7 +12,7 @@ from ...depgraph import DependencyGraph, GraphFormatter
 @click.argument('requirements_in', type=click.File('r'))
 @click.argument('requirements_txt', type=click.File('w'))
 def command(index, platform, requirements_in, requirements_txt):
-    graph = DependencyGraph(index, platform)
+    graph = get_graph_class()(index, platform)
     graph.compile(requirements_in.read())
 
     formatter = GraphFormatter()
@@ -1,3 +1,5 @@
+import os
+import json
 import itertools
 
 import six
@@ -8,50 +10,108 @@ from djclick.params import ModelInstance
 
 from celery_app import utils
 
-from ...models import BackingIndex
+from ...models import BackingIndex, Package
 from ...tasks import import_packages
 
 
+def load_checkpoint(path):
+    """
+    Returns the serial and the results of all the chunks recorded in the
+    checkpoint file at `path`, or ``(None, [])`` if it does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None, []
+    with open(path) as fh:
+        lines = [json.loads(line) for line in fh if line.strip()]
+    if not lines:
+        return None, []
+    return lines[0]['serial'], lines[1:]
+
+
 @click.command()
 @click.option('--initial/--no-initial',
               help='Perform the initial sync (not using diffs).')
+@click.option('--concurrency', type=int, default=None,
+              help='Number of packages to import in parallel while syncing '
+                   'updates (defaults to SYNC_CONCURRENCY).')
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help='File recording the progress of the initial sync, used '
+                   'to resume it without re-importing finished chunks.')
 @click.argument('index', type=ModelInstance(BackingIndex, lookup='slug'))
-def command(initial, index):
+def command(initial, concurrency, checkpoint, index):
     if not index.last_update_serial or initial:
-        chunk_size = 150  # Number of packages to update per task
-        concurrency = 30  # Number of concurrent tasks
+        chunk_size = 150  # Initial number of packages to update per task
+        chunk_duration = 60  # Targeted duration of a single task in seconds
+        tasks_concurrency = 30  # Number of concurrent tasks
 
-        # As we are syncing everything, get the current serial.
-        index.last_update_serial = index.client.changelog_last_serial()
+        serial, done_chunks = load_checkpoint(checkpoint)
+        if serial is None:
+            # As we are syncing everything, get the current serial.
+            serial = index.client.changelog_last_serial()
+            if checkpoint:
+                with open(checkpoint, 'w') as fh:
+                    fh.write(json.dumps({'serial': serial}) + '\n')
+        else:
+            click.secho('Resuming initial sync from {} ({} chunks done)...'
+                        .format(checkpoint, len(done_chunks)), fg='yellow')
+        index.last_update_serial = serial
 
         # Get the set of all existing packages. We will discard IDs of updated
         # packages from it and then remove all the remaining packages.
         all_package_ids = set(index.package_set.values_list('id', flat=True))
 
+        # Skip the packages already processed by an interrupted sync (failed
+        # ones are retried).
+        done_packages = set()
+        for chunk in done_chunks:
+            all_package_ids -= set(chunk['succeded'].values())
+            done_packages.update(chunk['succeded'])
+            done_packages.update(chunk['ignored'])
+
         # Get all the names of the packages on the selected index.
         click.secho('Fetching list of packages from {}...'.format(index.url),
                     fg='yellow')
-        all_packages = index.client.list_packages()
+        all_packages = [
+            package_name for package_name in index.client.list_packages()
+            if package_name not in done_packages
+        ]
 
         # Import all packages metadata in different chunks and tasks.
         click.secho('Importing {} packages...'.format(len(all_packages)),
                     fg='yellow')
-        # Create a generator of (index.pk, all_packages[i:i+chunk_size]) tuples
+        # Chunk sizes adapt to the measured import time per package, chunks
+        # are only built when a task slot becomes free.
+        chunker = utils.AdaptiveChunker(
+            chunk_size,
+            target_duration=chunk_duration,
+            min_size=10,
+            max_size=1000,
+        )
+        # Create a generator of (index.pk, chunk) tuples
         args = iterzip(
             itertools.repeat(index.pk),
-            utils.iter_chunks(all_packages, chunk_size),
+            chunker.iter_chunks(all_packages),
         )
         # Submit each tuple in args to the workers, but limit it to at most
-        # `concurrency` running tasks
-        results_iterator = utils.bounded_submitter(
+        # `tasks_concurrency` running tasks, and collect the results as soon
+        # as each task completes.
+        results_iterator = utils.unordered_submitter(
             import_packages,
-            concurrency,
+            tasks_concurrency,
             args,
         )
         with click.progressbar(length=len(all_packages), show_pos=True) as bar:
-            for succeded, ignored, failed in results_iterator:
-                bar.update(len(succeded) + len(ignored) + len(failed))
+            for (_, chunk), result, duration in results_iterator:
+                succeded, ignored, failed = result
+                chunker.record(len(chunk), duration)
+                bar.update(len(chunk))
                 all_package_ids -= set(succeded.values())
+                if checkpoint:
+                    with open(checkpoint, 'a') as fh:
+                        fh.write(json.dumps({
+                            'succeded': succeded,
+                            'ignored': ignored,
+                        }) + '\n')
                 if failed:
                     click.echo('')
                     for k, v in six.iteritems(failed):
@@ -62,15 +122,22 @@ def command(initial, index):
         # packages from the database.
         click.secho('Removing {} outdated packages...'
                     .format(len(all_package_ids)), fg='yellow')
-        index.package_set.filter(pk__in=all_package_ids).delete()
+        outdated_packages = index.package_set.filter(pk__in=all_package_ids)
+        Package.expire_packages_cache(index.slug, list(
+            outdated_packages.values_list('slug', flat=True),
+        ))
+        outdated_packages.delete()
         index.save(update_fields=['last_update_serial'])
+        index.update_projects()
+        if checkpoint:
+            os.remove(checkpoint)
 
     # Sync everything since the last serial, also when initial == True, as
     # something might have changed in the meantime...
     events = index.client.changelog_last_serial() - index.last_update_serial
     if events:
         click.secho('Syncing remaining updates...', fg='yellow')
-        sync_iter = index.itersync()
+        sync_iter = index.itersync(concurrency=concurrency)
         with click.progressbar(sync_iter, length=events, show_pos=True) as bar:
             for event in bar:
                 pass
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 09:12
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0028_auto_20170508_1327'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='package',
+            name='upstream_validators',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+    ]
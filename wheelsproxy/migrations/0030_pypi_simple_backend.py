@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 10:03
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0029_package_upstream_validators'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='backingindex',
+            name='backend',
+            field=models.CharField(choices=[('wheelsproxy.client.PyPIClient', 'PyPI'), ('wheelsproxy.client.PyPISimpleClient', 'PyPI (JSON simple index)'), ('wheelsproxy.client.DevPIClient', 'DevPI')], default='wheelsproxy.client.PyPIClient', max_length=255),
+        ),
+    ]
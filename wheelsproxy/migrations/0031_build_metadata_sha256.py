@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 14:37
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0030_pypi_simple_backend'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='build',
+            name='metadata_sha256',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64, verbose_name='METADATA SHA256 digest'),
+        ),
+        migrations.AddField(
+            model_name='externalbuild',
+            name='metadata_sha256',
+            field=models.CharField(blank=True, default='', editable=False, max_length=64, verbose_name='METADATA SHA256 digest'),
+        ),
+    ]
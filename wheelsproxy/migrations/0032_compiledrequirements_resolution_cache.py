@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 16:02
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0031_build_metadata_sha256'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compiledrequirements',
+            name='consulted_versions',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='compiledrequirements',
+            name='input_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=64),
+        ),
+    ]
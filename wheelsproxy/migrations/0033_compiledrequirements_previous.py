@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 16:40
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0032_compiledrequirements_resolution_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='compiledrequirements',
+            name='previous',
+            field=models.ForeignKey(blank=True, editable=False, help_text='Compilation whose pins are kept when still compatible.', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='wheelsproxy.CompiledRequirements'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-17 18:05
+from __future__ import unicode_literals
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0033_compiledrequirements_previous'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='backingindex',
+            name='serial_snapshot',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, editable=False, help_text='Last project listing seen, used to detect removals.', null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.8 on 2026-10-18 09:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('wheelsproxy', '0034_backingindex_serial_snapshot'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='backingindex',
+            name='serial_snapshot',
+        ),
+        migrations.CreateModel(
+            name='ProjectsSnapshot',
+            fields=[
+                ('index', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='wheelsproxy.BackingIndex')),
+                ('serials', models.BinaryField()),
+            ],
+        ),
+    ]
@@ -1,17 +1,25 @@
 import os
+import re
+import json
+import zlib
 import time
 import logging
 import hashlib
+import zipfile
+import functools
+import itertools
+import collections
+from concurrent import futures
 
 import six
 
 from pkg_resources import parse_version, Requirement, safe_extra
-from pkg_resources.extern.packaging.markers import Marker
 
 import furl
 
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
 from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.core.urlresolvers import reverse
 from django.conf import settings
 from django.utils import timezone
@@ -30,6 +38,8 @@ log = logging.getLogger(__name__)
 
 INDEX_BACKENDS = Choices(
     ('PYPI', 'wheelsproxy.client.PyPIClient', _('PyPI')),
+    ('PYPI_SIMPLE', 'wheelsproxy.client.PyPISimpleClient',
+     _('PyPI (JSON simple index)')),
     ('DEVPI', 'wheelsproxy.client.DevPIClient', _('DevPI')),
 )
 
@@ -77,6 +87,46 @@ def get_release(indexes, package_slug, version):
         raise Release.DoesNotExist('Release matching query could not be found')
 
 
+def encode_projects(projects):
+    return zlib.compress('\n'.join(sorted(projects)).encode('utf-8'))
+
+
+def decode_projects(blob):
+    projects = zlib.decompress(blob).decode('utf-8')
+    return set(projects.split('\n')) if projects else set()
+
+
+def encode_serials(serials):
+    return zlib.compress(json.dumps(serials, sort_keys=True).encode('utf-8'))
+
+
+def decode_serials(blob):
+    return json.loads(zlib.decompress(bytes(blob)).decode('utf-8'))
+
+
+def incr_cache_counters(keys):
+    """
+    Increments all the given cache counters, initializing missing ones to 1.
+
+    When the cache is backed by redis, all the increments are sent in a
+    single pipelined round-trip.
+    """
+    try:
+        client = cache.client.get_client(write=True)
+    except AttributeError:
+        # Not a django-redis backend
+        for key in keys:
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.set(key, 1, timeout=None)
+    else:
+        pipeline = client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.incr(cache.client.make_key(key))
+        pipeline.execute()
+
+
 class Platform(models.Model):
     DOCKER = 'docker'
     PLATFORM_CHOICES = [
@@ -108,6 +158,61 @@ class Platform(models.Model):
         )
         return build
 
+    def get_builds(self, releases, create=True):
+        """
+        Returns the builds of the given releases for this platform, in the
+        same order, creating the missing ones (or skipping them if `create`
+        is false). The number of queries does not depend on the number of
+        releases.
+        """
+        builds = {
+            build.release_id: build
+            for build in (Build.objects
+                          .filter(platform=self, release__in=releases)
+                          .select_related(None))
+        }
+
+        missing = [release for release in releases if release.pk not in builds]
+        if missing and create:
+            # The setup commands of the new builds come from the packages,
+            # load the ones the caller did not load with the releases.
+            packages = Package.objects.in_bulk({
+                release.package_id for release in missing
+                if not Release.package.is_cached(release)
+            })
+            for release in missing:
+                if release.package_id in packages:
+                    release.package = packages[release.package_id]
+            try:
+                with transaction.atomic():
+                    created = Build.objects.bulk_create([
+                        Build(
+                            release=release,
+                            platform=self,
+                            setup_commands=(
+                                release.package.default_setup_commands),
+                        )
+                        for release in missing
+                    ])
+            except IntegrityError:
+                # Some of the builds were concurrently created, fall back to
+                # creating them one by one.
+                created = [release.get_build(self) for release in missing]
+            builds.update((build.release_id, build) for build in created)
+
+        # Reuse the already loaded instances instead of fetching them again
+        # for each build when generating the links.
+        for release in releases:
+            if release.pk in builds:
+                builds[release.pk].release = release
+                builds[release.pk].platform = self
+
+        return [
+            builds[release.pk]
+            for release in releases
+            if release.pk in builds
+        ]
+
 
 class BackingIndex(models.Model):
     slug = models.SlugField(unique=True)
@@ -127,10 +232,26 @@ class BackingIndex(models.Model):
 
     def get_client(self):
         Client = import_string(self.backend)
-        return Client(self.url)
+        client = Client(self.url)
+        if hasattr(client, 'snapshot_store'):
+            client.snapshot_store = self
+        return client
 
     client = cached_property(get_client)
 
+    def load_snapshot(self):
+        try:
+            blob = (ProjectsSnapshot.objects
+                    .values_list('serials', flat=True)
+                    .get(index=self))
+        except ProjectsSnapshot.DoesNotExist:
+            return None
+        return decode_serials(blob)
+
+    def store_snapshot(self, snapshot):
+        ProjectsSnapshot.objects.update_or_create(
+            index=self, defaults={'serials': encode_serials(snapshot)})
+
     def get_package(self, package_name, create=True):
         normalized_package_name = utils.normalize_package_name(package_name)
         if create:
@@ -143,67 +264,289 @@ class BackingIndex(models.Model):
             package = self.package_set.get(slug=normalized_package_name)
         return package
 
-    def itersync(self):
-        serial = self.last_update_serial
-        packages_to_update = self.client.iter_updated_packages(serial)
+    def get_candidates(self, package_names):
+        """
+        Returns a mapping of the normalized names of the given packages to
+        the ``(parsed_version, release)`` tuples of their releases on this
+        index, newest first. Packages missing from this index are omitted.
+
+        All the releases are loaded with a single query.
+        """
+        slugs = {utils.normalize_package_name(n) for n in package_names}
+        candidates = collections.defaultdict(list)
+        releases = (Release.objects
+                    .filter(package__index=self, package__slug__in=slugs)
+                    .select_related('package'))
+        for release in releases:
+            release.package.index = self
+            candidates[release.package.slug].append(
+                (release.parsed_version, release))
+        for versions in candidates.values():
+            versions.sort(reverse=True, key=lambda v: v[0])
+        return dict(candidates)
+
+    def _sync_package(self, package_name, serial):
+        if not self.import_package(package_name, ensure_serial=serial):
+            # Nothing imported: remove the package
+            slug = utils.normalize_package_name(package_name)
+            Package.objects.filter(index=self, slug=slug).delete()
+            Package.expire_package_cache(self.slug, slug)
+
+    def _sync_package_in_thread(self, package_name, serial, previous=None):
+        if previous is not None:
+            # Imports of the same package are chained, so that two threads
+            # never write the releases of a single package at the same time.
+            futures.wait([previous])
+        try:
+            self._sync_package(package_name, serial)
+        finally:
+            # Each worker thread gets its own database connection
+            connection.close()
+
+    def _iter_serial_sync(self, packages_to_update):
         for package_name, serial in packages_to_update:
             if package_name:
-                if not self.import_package(package_name, ensure_serial=serial):
-                    # Nothing imported: remove the package
-                    slug = utils.normalize_package_name(package_name)
-                    Package.objects.filter(index=self, slug=slug).delete()
-                    cache.delete(
-                        Package.get_cache_version_key(self.slug, slug),
+                self._sync_package(package_name, serial)
+            yield serial
+
+    def _iter_concurrent_sync(self, packages_to_update, concurrency):
+        # Events are fanned out to a pool of threads, but serials are only
+        # yielded in changelog order and once every event up to (and
+        # including) them has been processed, so that the checkpoint never
+        # skips over a package which failed or is still being imported.
+        max_pending = concurrency * 10
+        pending = collections.deque()
+        in_flight = {}
+
+        def complete_head():
+            package_name, serial, future = pending.popleft()
+            if future is not None:
+                future.result()
+                if in_flight.get(package_name) is future:
+                    del in_flight[package_name]
+            return serial
+
+        with futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for package_name, serial in packages_to_update:
+                future = None
+                if package_name:
+                    future = executor.submit(
+                        self._sync_package_in_thread,
+                        package_name,
+                        serial,
+                        in_flight.get(package_name),
                     )
-
+                    in_flight[package_name] = future
+                pending.append((package_name, serial, future))
+
+                while pending and (
+                    len(pending) >= max_pending or
+                    pending[0][2] is None or
+                    pending[0][2].done()
+                ):
+                    yield complete_head()
+
+            while pending:
+                yield complete_head()
+
+    def itersync(self, concurrency=None):
+        if concurrency is None:
+            concurrency = settings.SYNC_CONCURRENCY
+        serial = self.last_update_serial
+        touched_packages = set()
+
+        def record_touched(events):
+            for package_name, serial in events:
+                if package_name:
+                    touched_packages.add(package_name)
+                yield package_name, serial
+
+        packages_to_update = record_touched(
+            self.client.iter_updated_packages(serial))
+        if concurrency > 1:
+            serials = self._iter_concurrent_sync(
+                packages_to_update,
+                concurrency,
+            )
+        else:
+            serials = self._iter_serial_sync(packages_to_update)
+        for serial in serials:
             if serial > self.last_update_serial:
                 self.last_update_serial = serial
                 yield self.last_update_serial
         self.save(update_fields=['last_update_serial'])
-
-    def sync(self):
-        for i in self.itersync():
+        if touched_packages:
+            self.update_projects(touched_packages)
+        if self.client.bytes_saved:
+            log.info('Conditional requests to {} saved {} bytes'
+                     .format(self.url, self.client.bytes_saved))
+
+    def sync(self, concurrency=None):
+        for i in self.itersync(concurrency=concurrency):
             pass
 
     def import_package(self, package_name, ensure_serial=None):
         # log.info('importing {} from {}'.format(package_name, self.url))
+        slug = utils.normalize_package_name(package_name)
+        package = self.package_set.filter(slug=slug).first()
         try:
             versions = self.client.get_package_releases(
                 package_name,
                 ensure_serial=ensure_serial,
+                validators=package.upstream_validators if package else None,
             )
         except client.PackageNotFound:
             log.debug('package {} not found on {}'
                       .format(package_name, self.url))
             return
+        except client.NotModified:
+            return package.pk
+        return self.store_package(package_name, versions, package=package)
+
+    def import_packages(self, package_names):
+        """
+        Fetches the releases of all the given packages concurrently and
+        stores them as soon as they are available.
+
+        Yields a ``(package_name, package_id, error)`` tuple for each
+        package, in completion order.
+        """
+        slugs = {
+            package_name: utils.normalize_package_name(package_name)
+            for package_name in package_names
+        }
+        existing = {
+            slug: (package_id, validators)
+            for slug, package_id, validators in (
+                self.package_set
+                .filter(slug__in=slugs.values())
+                .values_list('slug', 'pk', 'upstream_validators')
+            )
+        }
+        results = self.client.iter_package_releases(package_names, {
+            package_name: existing[slug][1]
+            for package_name, slug in six.iteritems(slugs)
+            if slug in existing
+        })
+        for package_name, versions, error in results:
+            package_id = None
+            if isinstance(error, client.PackageNotFound):
+                log.debug('package {} not found on {}'
+                          .format(package_name, self.url))
+                error = None
+            elif isinstance(error, client.NotModified):
+                package_id = existing[slugs[package_name]][0]
+                error = None
+            elif error is None:
+                try:
+                    package_id = self.store_package(package_name, versions)
+                except Exception as e:
+                    error = e
+            yield package_name, package_id, error
+
+    def store_package(self, package_name, versions, package=None):
         if not versions:
             log.debug('no versions found for package {} on {}'
                       .format(package_name, self.url))
             return
-        package = self.get_package(package_name)
-        release_ids = []
-        for version, releases in six.iteritems(versions):
-            release_details = package.get_best_release(releases)
-            if not release_details:
-                continue
-            release = package.get_release(version, release_details)
-            release_ids.append(release.pk)
-        if release_ids:
-            # Remove outdated releases
-            package.release_set.exclude(pk__in=release_ids).delete()
-            # Expire the cache
-            package.expire_cache()
-        return package.pk if release_ids else None
+        validators = getattr(versions, 'validators', None)
+        with transaction.atomic():
+            if package is None:
+                package = self.get_package(package_name)
+            changes = package.import_releases(versions)
+            if changes is not None and (
+                    validators != package.upstream_validators):
+                package.upstream_validators = validators
+                package.save(update_fields=['upstream_validators'])
+        if changes is None:
+            return None
+        log.debug('imported {} from {}: {} created, {} updated, {} deleted'
+                  .format(package_name, self.url, *changes))
+        # Expire the cache
+        Package.expire_package_cache(self.slug, package.slug)
+        return package.pk
 
     def expire_cache(self):
-        for slug in self.package_set.values_list('slug', flat=True):
-            Package.expire_package_cache(self.slug, slug)
+        Package.expire_index_cache(self.slug)
+
+    @staticmethod
+    def get_root_version_key(index_slug):
+        return 'root/index:{}'.format(index_slug)
+
+    @staticmethod
+    def get_root_variants_key(index_slug):
+        return 'pages/index:{}/root'.format(index_slug)
+
+    def get_projects_key(self):
+        return 'projects/index:{}'.format(self.slug)
+
+    def get_projects(self):
+        """
+        Returns the set of the slugs of all the packages in this index.
+        """
+        blob = cache.get(self.get_projects_key())
+        if blob is None:
+            return self.update_projects()
+        return decode_projects(blob)
+
+    def update_projects(self, package_names=None):
+        """
+        Updates the cached set of the slugs of all the packages in this
+        index, only checking the given packages if the set is already
+        cached. Expires the root listings if the set changed.
+        """
+        key = self.get_projects_key()
+        blob = cache.get(key)
+
+        if blob is None or package_names is None:
+            previous = decode_projects(blob) if blob is not None else None
+            projects = set(
+                self.package_set.values_list('slug', flat=True).iterator())
+        else:
+            previous = decode_projects(blob)
+            slugs = {
+                utils.normalize_package_name(package_name)
+                for package_name in package_names
+            }
+            existing = set(self.package_set.filter(slug__in=slugs)
+                           .values_list('slug', flat=True))
+            projects = (previous - slugs) | existing
+
+        if projects != previous:
+            cache.set(key, encode_projects(projects), timeout=None)
+            self.expire_root_cache()
+
+        return projects
+
+    def expire_root_cache(self):
+        incr_cache_counters([self.get_root_version_key(self.slug)])
+        if cache.get(self.get_root_variants_key(self.slug)):
+            slug = self.slug
+            transaction.on_commit(
+                lambda: tasks.regenerate_root_pages.delay(slug))
+
+
+class ProjectsSnapshot(models.Model):
+    """
+    The last project listing seen on an index, mapping the project names to
+    their last serial, used by the clients diffing listings to detect the
+    removed projects. It is large and only read while syncing, so it is not
+    stored on `BackingIndex` itself.
+    """
+    index = models.OneToOneField(
+        BackingIndex,
+        primary_key=True,
+        related_name='+',
+        on_delete=models.CASCADE,
+    )
+    serials = models.BinaryField()
 
 
 class Package(models.Model):
     name = models.CharField(max_length=255)
     slug = models.SlugField(max_length=255)
     index = models.ForeignKey(BackingIndex)
+    upstream_validators = JSONField(null=True, blank=True, editable=False)
     default_setup_commands = models.TextField(
         default='',
         blank=True,
@@ -254,19 +597,91 @@ class Package(models.Model):
             instance.save(update_fields=['url', 'md5_digest'])
         return instance
 
+    def import_releases(self, versions):
+        """
+        Synchronizes the releases of this package with the given mapping of
+        versions to release details using a constant number of queries.
+
+        Returns a ``(created, updated, deleted)`` tuple of counts, or
+        ``None`` if none of the versions had a usable release.
+        """
+        details = {}
+        for version, releases in six.iteritems(versions):
+            release = self.get_best_release(releases)
+            if release:
+                details[utils.normalize_version(version)] = release
+        if not details:
+            return None
+
+        existing = {
+            release.version: release
+            for release in (Release.objects
+                            .filter(package=self)
+                            .only('pk', 'version', 'url', 'md5_digest'))
+        }
+        to_create, to_update = [], []
+        for version, release in six.iteritems(details):
+            instance = existing.pop(version, None)
+            if instance is None:
+                assert release.url
+                to_create.append(Release(
+                    package=self,
+                    version=version,
+                    url=release.url,
+                    md5_digest=release.md5_digest,
+                ))
+            elif (instance.url != release.url or
+                    instance.md5_digest != release.md5_digest):
+                instance.url = release.url
+                instance.md5_digest = release.md5_digest
+                to_update.append(instance)
+
+        with transaction.atomic(savepoint=False):
+            if to_create:
+                Release.objects.bulk_create(to_create)
+            if to_update:
+                Release.objects.bulk_update_details(to_update)
+            if existing:
+                # Remove outdated releases
+                Release.objects.filter(pk__in=[
+                    release.pk for release in existing.values()
+                ]).delete()
+
+        return len(to_create), len(to_update), len(existing)
+
     @classmethod
     def get_cache_key(cls, namespace, index_slugs, platform_slug,
                       package_name):
-        version_keys = sorted([
+        version_keys = cls.get_cache_version_keys(index_slugs, package_name)
+        versions = cache.get_many(version_keys)
+        return cls.format_cache_key(
+            namespace,
+            index_slugs,
+            platform_slug,
+            package_name,
+            cls.get_cache_version_hash(version_keys, versions),
+        )
+
+    @classmethod
+    def get_cache_version_keys(cls, index_slugs, package_name):
+        return sorted([
             cls.get_cache_version_key(index_slug, package_name)
             for index_slug in index_slugs
+        ] + [
+            cls.get_cache_generation_key(index_slug)
+            for index_slug in index_slugs
         ])
-        versions = cache.get_many(version_keys)
-        version_hash = ','.join(
+
+    @staticmethod
+    def get_cache_version_hash(version_keys, versions):
+        return ','.join(
             str(versions.get(k, 0))
             for k in version_keys
         )
 
+    @staticmethod
+    def format_cache_key(namespace, index_slugs, platform_slug, package_name,
+                         version_hash):
         return '{}/indexes:{}/platform:{}/package:{}/v:{}'.format(
             namespace,
             '+'.join(index_slugs),
@@ -279,32 +694,55 @@ class Package(models.Model):
     def get_cache_version_key(index_slug, package_name):
         return 'serial/index:{}/package:{}'.format(index_slug, package_name)
 
+    @staticmethod
+    def get_cache_generation_key(index_slug):
+        return 'generation/index:{}'.format(index_slug)
+
+    @staticmethod
+    def get_pages_variants_key(index_slug, package_name):
+        return 'pages/index:{}/package:{}'.format(index_slug, package_name)
+
     @classmethod
     def expire_package_cache(cls, index_slug, package_name):
-        key = cls.get_cache_version_key(index_slug, package_name)
-        try:
-            cache.incr(key)
-        except ValueError:
-            cache.set(key, 1, timeout=None)
+        cls.expire_packages_cache(index_slug, [package_name])
+
+    @classmethod
+    def expire_packages_cache(cls, index_slug, package_names):
+        incr_cache_counters([
+            cls.get_cache_version_key(index_slug, package_name)
+            for package_name in package_names
+        ])
+        cls.schedule_pages_regeneration(index_slug, package_names)
+
+    @classmethod
+    def schedule_pages_regeneration(cls, index_slug, package_names):
+        """
+        Regenerates in the background the recently served pages of the
+        given packages, once the current transaction is committed.
+        """
+        keys = {
+            cls.get_pages_variants_key(index_slug, package_name): package_name
+            for package_name in package_names
+        }
+        served = cache.get_many(list(keys))
+
+        def schedule():
+            for key in served:
+                tasks.regenerate_package_pages.delay(index_slug, keys[key])
+
+        if served:
+            transaction.on_commit(schedule)
+
+    @classmethod
+    def expire_index_cache(cls, index_slug):
+        incr_cache_counters([cls.get_cache_generation_key(index_slug)])
 
     def expire_cache(self):
         self.expire_package_cache(self.index.slug, self.slug)
 
     def get_builds(self, platform, check=True):
-        releases = (Release.objects
-                    .filter(package=self)
-                    .order_by('-version')
-                    .only('pk')
-                    .all())
-        builds_qs = (Build.objects
-                     .filter(release__in=releases, platform=platform)
-                     .order_by('-release__version')
-                     .all())
-
-        if check and (len(builds_qs) != len(releases)):
-            return [r.get_build(platform) for r in releases]
-        else:
-            return list(builds_qs)
+        releases = list(self.release_set.order_by('-version'))
+        return platform.get_builds(releases, create=check)
 
     def get_versions(self):
         return sorted([
@@ -313,6 +751,26 @@ class Package(models.Model):
         ], reverse=True, key=lambda r: r[0])
 
 
+class ReleaseQuerySet(models.QuerySet):
+    def bulk_update_details(self, releases):
+        """
+        Writes the ``url`` and ``md5_digest`` of all the given releases with
+        a single ``UPDATE`` query.
+        """
+        def case(attr):
+            return models.Case(*[
+                models.When(pk=release.pk, then=models.Value(
+                    getattr(release, attr),
+                )) for release in releases
+            ], output_field=Release._meta.get_field(attr))
+
+        return self.filter(pk__in=[release.pk for release in releases]).update(
+            url=case('url'),
+            md5_digest=case('md5_digest'),
+            last_update=timezone.now(),
+        )
+
+
 class Release(models.Model):
     package = models.ForeignKey(Package)
     version = models.CharField(max_length=200, db_index=True)
@@ -331,6 +789,8 @@ class Release(models.Model):
     )
     last_update = models.DateTimeField(auto_now=True)
 
+    objects = ReleaseQuerySet.as_manager()
+
     class Meta:
         unique_together = ('package', 'version')
         ordering = ('package', 'version')
@@ -350,11 +810,36 @@ class Release(models.Model):
     def parsed_version(self):
         return parse_version(self.version)
 
-    @property
+    @cached_property
     def requirement(self):
         return Requirement('{}=={}'.format(self.package.slug, self.version))
 
 
+def iter_requires_dist(requires_dist, extras, environment):
+    """
+    Yields the requirements out of the pre-parsed ``Requires-Dist`` entries
+    (see ``builder.parse_wheel_metadata``) which apply to the given
+    environment when the given extras are requested.
+    """
+    environments = [
+        dict(environment or {}, extra=extra)
+        for extra in [''] + sorted({safe_extra(extra) for extra in extras})
+    ]
+    for requirement, marker in requires_dist:
+        if marker:
+            marker = utils.parse_marker(marker)
+            if not any(marker.evaluate(env) for env in environments):
+                continue
+        yield utils.parse_requirement_spec(requirement)
+
+
+@functools.lru_cache(maxsize=16384)
+def parse_legacy_requirement(requirement, extras):
+    req = utils.parse_requirement(requirement)
+    req.extras = extras
+    return Requirement(str(req))
+
+
 def upload_build_to(self, filename):
     return os.path.join(
         self.release.package.index.slug,
@@ -396,6 +881,13 @@ class BuildBase(models.Model):
         editable=False,
     )
     metadata = JSONField(null=True, blank=True, editable=False)
+    metadata_sha256 = models.CharField(
+        verbose_name=_('METADATA SHA256 digest'),
+        max_length=64,
+        default='',
+        blank=True,
+        editable=False,
+    )
     filesize = models.PositiveIntegerField(
         blank=True, null=True,
         editable=False,
@@ -431,9 +923,14 @@ class BuildBase(models.Model):
         assert self.metadata
 
         meta = self.metadata
-        extras = extras if extras else frozenset([])
+        extras = frozenset(extras) if extras else frozenset([])
         env = self.platform.environment
 
+        if 'requires_dist' in meta:
+            yield from iter_requires_dist(meta['requires_dist'], extras, env)
+            return
+
+        # Legacy metadata.json format (PEP 426)
         def process(requirement_sets, extras, environment):
             for requirements in requirement_sets:
                 if 'extra' in requirements:
@@ -441,14 +938,12 @@ class BuildBase(models.Model):
                         continue
 
                 if 'environment' in requirements:
-                    marker = Marker(requirements['environment'])
+                    marker = utils.parse_marker(requirements['environment'])
                     if not marker.evaluate(environment):
                         continue
 
                 for req in requirements['requires']:
-                    req = utils.parse_requirement(req)
-                    req.extras = extras
-                    yield Requirement(str(req))
+                    yield parse_legacy_requirement(req, extras)
 
         yield from process(meta.get('run_requires', []), extras, env)
         yield from process(meta.get('meta_requires', []), extras, env)
@@ -457,6 +952,56 @@ class BuildBase(models.Model):
         return bool(self.build)
     is_built.boolean = True
 
+    def fetch_metadata(self):
+        """
+        Fills ``metadata`` with the ``METADATA`` file of the original release
+        file without building it, if the release is a wheel installable as-is
+        on the platform. Only the parts of the wheel containing the file are
+        downloaded, using HTTP range requests.
+
+        Returns whether the metadata of this build is available.
+        """
+        if self.metadata:
+            return True
+        if not utils.is_pure_wheel(self.original_url,
+                                   self.platform.environment):
+            return False
+
+        try:
+            with client.RemoteFile(self.original_url) as fh:
+                content = builder.extract_wheel_metadata_file(fh)
+        except (IOError, zipfile.BadZipFile) as e:
+            log.warning('could not fetch the metadata of {}: {}'.format(
+                self.original_url, e))
+            return False
+        if content is None:
+            return False
+
+        self.metadata = builder.parse_wheel_metadata(content)
+        self.save(update_fields=['metadata'])
+        return True
+
+    def has_metadata_file(self):
+        return self.is_built() and bool(self.metadata_sha256)
+
+    def get_metadata_file_name(self):
+        # The metadata file is stored next to the build, so that its URL
+        # is the URL of the build followed by ".metadata" (PEP 658).
+        return self.build.name + '.metadata'
+
+    def save_metadata_file(self, content):
+        if content is None:
+            self.metadata_sha256 = ''
+        else:
+            self.build.storage.save(
+                self.get_metadata_file_name(),
+                ContentFile(content),
+            )
+            self.metadata_sha256 = hashlib.sha256(content).hexdigest()
+
+    def get_metadata_file_url(self):
+        return self.build.storage.url(self.get_metadata_file_name())
+
     def get_build_url(self, build_if_needed=False, include_digest=False):
         if self.is_built():
             url = self.build.url
@@ -472,8 +1017,11 @@ class BuildBase(models.Model):
             return url
 
     def rebuild(self):
-        builder = self.platform.get_builder()
-        builder.build(self)
+        if utils.is_pure_wheel(self.original_url, self.platform.environment):
+            # The wheel can be served as-is, no need for a container
+            builder.mirror_wheel(self)
+        else:
+            self.platform.get_builder().build(self)
 
     @property
     def filename(self):
@@ -597,12 +1145,56 @@ class ExternalBuild(BuildBase):
         return None
 
 
+# Matches the pinned packages of a compiled requirements file, along with
+# their optional extras
+PINNED_REQUIREMENT_RE = re.compile(
+    r'^([A-Za-z0-9][A-Za-z0-9._-]*)(?:\[[^\]]*\])?==([^\s;#]+)', re.M)
+
+
+class CompiledRequirementsQuerySet(models.QuerySet):
+    def get_cached(self, platform, index_slugs, requirements):
+        """
+        Returns the last successful compilation of the same requirements,
+        if none of the packages it consulted changed since, or ``None``.
+        """
+        input_hash = CompiledRequirements.get_input_hash(
+            platform, index_slugs, requirements)
+        compiled = (self
+                    .filter(input_hash=input_hash,
+                            consulted_versions__isnull=False,
+                            pip_compilation_status=COMPILATION_STATUSES.DONE)
+                    .order_by('-created_at')
+                    .first())
+        if compiled is not None and compiled.is_up_to_date():
+            return compiled
+        return None
+
+
 class CompiledRequirements(models.Model):
     platform = models.ForeignKey(Platform)
     requirements = models.TextField()
     index_url = models.URLField()
     index_slugs = ArrayField(models.SlugField())
     created_at = models.DateTimeField(auto_now_add=True)
+    previous = models.ForeignKey(
+        'self',
+        null=True, blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name='+',
+        help_text=_('Compilation whose pins are kept when still compatible.'),
+    )
+
+    input_hash = models.CharField(
+        max_length=64,
+        default='',
+        blank=True,
+        editable=False,
+        db_index=True,
+    )
+    # Maps the packages consulted by the compilation to their cache
+    # versions at the time, see `Package.get_cache_version_keys`.
+    consulted_versions = JSONField(null=True, blank=True, editable=False)
 
     pip_compilation_status = models.CharField(
         max_length=12,
@@ -642,6 +1234,67 @@ class CompiledRequirements(models.Model):
     internal_compilation_log = models.TextField(
         _('Compilation log'), blank=True, editable=False)
 
+    objects = CompiledRequirementsQuerySet.as_manager()
+
+    @staticmethod
+    def get_input_hash(platform, index_slugs, requirements):
+        """
+        Hashes everything the result of a compilation depends on, apart
+        from the state of the consulted packages.
+        """
+        try:
+            normalized = sorted({
+                str(req) for req in utils.parse_requirements(requirements)
+            })
+        except ValueError:
+            normalized = sorted(set(utils.split_requirements(requirements)))
+        payload = json.dumps([
+            normalized,
+            list(index_slugs),
+            platform.slug,
+            platform.environment,
+        ], sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def get_package_versions(self, package_names):
+        version_keys = {
+            name: Package.get_cache_version_keys(self.index_slugs, name)
+            for name in package_names
+        }
+        versions = cache.get_many(list(set(itertools.chain.from_iterable(
+            version_keys.values()))))
+        return {
+            name: Package.get_cache_version_hash(keys, versions)
+            for name, keys in version_keys.items()
+        }
+
+    def record_consulted_packages(self, compiled_requirements):
+        package_names = {
+            utils.normalize_package_name(match.group(1))
+            for match in PINNED_REQUIREMENT_RE.finditer(compiled_requirements)
+        }
+        self.consulted_versions = self.get_package_versions(package_names)
+        self.save(update_fields=['consulted_versions'])
+
+    def get_pins(self, mode='pip'):
+        """
+        Returns a mapping of the names of the packages pinned by this
+        compilation to their versions, if it succeeded.
+        """
+        if not self.is_compiled(mode):
+            return {}
+        return {
+            utils.normalize_package_name(name): version
+            for name, version in PINNED_REQUIREMENT_RE.findall(
+                self._mode_attr(mode, 'compiled_requirements'))
+        }
+
+    def is_up_to_date(self):
+        if self.consulted_versions is None:
+            return False
+        return self.consulted_versions == self.get_package_versions(
+            self.consulted_versions.keys())
+
     def _mode_attr(self, mode, attr):
         return getattr(self, '{}_{}'.format(mode, attr))
 
@@ -657,6 +1310,8 @@ class CompiledRequirements(models.Model):
     def pip_recompile(self):
         builder = self.platform.get_builder()
         builder.compile(self)
+        if self.is_compiled():
+            self.record_consulted_packages(self.pip_compiled_requirements)
 
     def internal_recompile(self):
         start = time.time()
@@ -664,10 +1319,14 @@ class CompiledRequirements(models.Model):
         indexes = BackingIndex.objects.filter(slug__in=self.index_slugs)
         indexes = sorted(indexes, key=lambda i: self.index_slugs.index(i.slug))
 
-        graph = depgraph.DependencyGraph(indexes, self.platform)
+        graph = depgraph.get_graph_class()(indexes, self.platform)
+
+        preferred = None
+        if self.previous is not None:
+            preferred = self.previous.get_pins('internal')
 
         try:
-            graph.compile(self.requirements)
+            graph.compile(self.requirements, preferred=preferred)
         except depgraph.CompilationFailed:
             self.internal_compilation_status = COMPILATION_STATUSES.FAILED
             raise
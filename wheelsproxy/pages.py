@@ -0,0 +1,547 @@
+"""
+Materialized simple index pages.
+
+Package pages and root listings are rendered once, stored as pre-gzipped
+bytes under a versioned cache key and served as-is. Every served
+combination of indexes and platform is remembered, so that the pages can
+be rendered again in the background as soon as their content changes,
+instead of on the next request.
+"""
+
+import io
+import os
+import re
+import gzip
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.template.loader import render_to_string
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.html import escape
+from django.utils.http import parse_etags, quote_etag
+from django.utils.safestring import mark_safe
+
+from . import models, utils
+
+
+log = logging.getLogger(__name__)
+
+PAGES_NAMESPACE = 'links'
+PAGES_JSON_NAMESPACE = 'links-json'
+
+ROOT_NAMESPACE = 'root'
+ROOT_JSON_NAMESPACE = 'root-json'
+
+SIMPLE_API_VERSION = '1.0'
+
+HTML_CONTENT_TYPE = 'text/html; charset=utf-8'
+JSON_CONTENT_TYPE = 'application/vnd.pypi.simple.v1+json'
+
+CONTENT_TYPES = {
+    'text/html': HTML_CONTENT_TYPE,
+    '*/*': HTML_CONTENT_TYPE,
+    'application/vnd.pypi.simple.v1+html': HTML_CONTENT_TYPE,
+    'application/vnd.pypi.simple.latest+html': HTML_CONTENT_TYPE,
+    'application/vnd.pypi.simple.v1+json': JSON_CONTENT_TYPE,
+    'application/vnd.pypi.simple.latest+json': JSON_CONTENT_TYPE,
+}
+
+ACCEPTS_GZIP = re.compile(r'\bgzip\b')
+
+VERSION_PLACEHOLDER = '{version}'
+
+# Matches any version in If-None-Match
+ANY_VERSION = '*'
+
+# Returned in place of a stored value the client already has
+NOT_MODIFIED = object()
+
+# Builds the version hash out of the version counters passed as KEYS (see
+# Package.get_cache_version_hash) and returns it along with the value stored
+# under ARGV[1] .. version_hash .. ARGV[2]. If the version hash is equal to
+# one of the already known versions in ARGV[3:], only the existence of the
+# value is returned.
+GET_VERSIONED_SCRIPT = """
+local versions = {}
+for i, key in ipairs(KEYS) do
+    versions[i] = redis.call('GET', key) or '0'
+end
+local version = table.concat(versions, ',')
+local key = ARGV[1] .. version .. ARGV[2]
+for i = 3, #ARGV do
+    if version == ARGV[i] or ARGV[i] == '*' then
+        return {version, false, redis.call('EXISTS', key)}
+    end
+end
+return {version, redis.call('GET', key)}
+"""
+
+# Per-process cache of the most recently served pages
+local_cache = utils.VersionedLRUCache(settings.PAGES_LOCAL_CACHE_SIZE)
+
+
+def compress(content):
+    buf = io.BytesIO()
+    # Use a fixed mtime so that the same page always compresses to the
+    # same bytes.
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as fh:
+        fh.write(content)
+    return buf.getvalue()
+
+
+def _fetch_versioned(key, version_keys, known_versions):
+    """
+    Returns the current version hash, the value stored under the given
+    versioned key and whether it exists. The value is not fetched if the
+    version is one of the ``known_versions``, only its existence is checked.
+    """
+    known_versions = [v for v in known_versions if v]
+
+    try:
+        client = cache.client
+        redis = client.get_client(write=False)
+    except AttributeError:
+        # Not a django-redis backend, resolve the key first
+        version = models.Package.get_cache_version_hash(
+            version_keys, cache.get_many(version_keys))
+        versioned_key = key.replace(VERSION_PLACEHOLDER, version)
+        if version in known_versions or ANY_VERSION in known_versions:
+            return version, None, versioned_key in cache
+        value = cache.get(versioned_key)
+        return version, value, value is not None
+
+    prefix, _, suffix = client.make_key(key).partition(VERSION_PLACEHOLDER)
+    script = redis.register_script(GET_VERSIONED_SCRIPT)
+    result = script(
+        keys=[client.make_key(k) for k in version_keys],
+        args=[prefix, suffix] + known_versions,
+    )
+    version = result[0].decode('utf-8')
+    if len(result) > 2:
+        return version, None, bool(result[2])
+    if result[1] is None:
+        return version, None, False
+    return version, client.decode(result[1]), True
+
+
+def log_local_cache_stats(local_cache):
+    """
+    Logs the statistics of the given local cache of the current process,
+    at most once every ``PAGES_LOCAL_CACHE_STATS_INTERVAL`` seconds.
+    """
+    interval = settings.PAGES_LOCAL_CACHE_STATS_INTERVAL
+    if not interval:
+        return
+    stats = local_cache.stats_if_due(interval)
+    if stats is not None:
+        log.info('local pages cache of process {}: {}'.format(
+            os.getpid(),
+            ', '.join('{}={}'.format(k, v) for k, v in sorted(stats.items())),
+        ))
+
+
+def get_versioned(key, version_keys, client_versions=(), local_cache=None):
+    """
+    Returns the current version hash and the value cached under the given
+    versioned key, resolving the key and fetching the value in a single
+    round-trip when the cache is backed by redis. The version hash is
+    built out of the counters stored at ``version_keys`` and replaces the
+    ``VERSION_PLACEHOLDER`` in the key.
+
+    If the current version is one of the ``client_versions`` (or they
+    contain ``ANY_VERSION``) and the value is stored, it is not fetched at
+    all and ``NOT_MODIFIED`` is returned in its place. Values are only
+    stored for existing targets, so that a client is never told that a
+    missing page did not change.
+
+    If a ``local_cache`` is given, values are kept in it as well and are
+    only transferred from the shared cache when their version changed.
+    """
+    known_version = None
+    if local_cache is not None:
+        log_local_cache_stats(local_cache)
+        known_version = local_cache.get_version(key)
+
+    version, value, exists = _fetch_versioned(
+        key, version_keys, [known_version] + list(client_versions))
+
+    if version in client_versions or ANY_VERSION in client_versions:
+        if exists:
+            return version, NOT_MODIFIED
+        return version, None
+
+    if local_cache is None:
+        return version, value
+
+    local_value = local_cache.get(key, version)
+    if local_value is not None:
+        return version, local_value
+
+    if value is None and version == known_version:
+        # The local value was evicted in the meantime
+        value = cache.get(key.replace(VERSION_PLACEHOLDER, version))
+
+    if value is not None:
+        local_cache.set(key, version, value)
+
+    return version, value
+
+
+def get_page(index_slugs, platform_slug, package_name, client_versions=(),
+             local_cache=local_cache, namespace=PAGES_NAMESPACE):
+    """
+    Returns the current version of the page for the given package along
+    with its compressed content, ``None`` if it was not generated yet or
+    ``NOT_MODIFIED`` if the client already has the current version.
+    """
+    return get_versioned(
+        models.Package.format_cache_key(
+            namespace, index_slugs, platform_slug, package_name,
+            VERSION_PLACEHOLDER,
+        ),
+        models.Package.get_cache_version_keys(index_slugs, package_name),
+        client_versions=client_versions,
+        local_cache=local_cache,
+    )
+
+
+def get_links(indexes, platform, package_name):
+    unique_builds = utils.UniquesIterator(lambda b: b.release.version)
+
+    links = []
+    found = False
+
+    for index in indexes:
+        try:
+            package = index.package_set.get(slug=package_name)
+        except models.Package.DoesNotExist:
+            package = None
+            builds = []
+        else:
+            found = True
+            builds = package.get_builds(platform)
+            builds = list(unique_builds(builds))
+        links.append((index, package, builds))
+
+    return links if found else None
+
+
+def render_html_page(package_name, platform, links):
+    return render_to_string('wheelsproxy/simple.html', {
+        'package_name': package_name,
+        'platform': platform,
+        'links': links,
+    })
+
+
+def render_json_page(package_name, platform, links):
+    files = []
+    for index, package, builds in links:
+        for build in builds:
+            digest = build.get_digest()
+            info = {
+                'filename': build.filename,
+                'url': build.get_absolute_url(),
+                'hashes': {'md5': digest} if digest else {},
+            }
+            if build.is_built() and build.filesize is not None:
+                info['size'] = build.filesize
+            if build.has_metadata_file():
+                metadata = {'sha256': build.metadata_sha256}
+                info['dist-info-metadata'] = metadata
+                info['core-metadata'] = metadata
+            files.append(info)
+
+    return json.dumps({
+        'meta': {'api-version': SIMPLE_API_VERSION},
+        'name': package_name,
+        'files': files,
+    }, separators=(',', ':'))
+
+
+PAGE_RENDERERS = {
+    PAGES_NAMESPACE: render_html_page,
+    PAGES_JSON_NAMESPACE: render_json_page,
+}
+
+
+def build_page(indexes, platform, package_name, store=True,
+               namespace=PAGES_NAMESPACE):
+    """
+    Renders and compresses the page for the given package. Returns the
+    version of the page along with its content, or ``None`` if the package
+    does not exist in any of the given indexes.
+    """
+    index_slugs = [index.slug for index in indexes]
+
+    # Resolve the key before rendering: if the package changes while the
+    # page is being rendered, the page is stored under an already outdated
+    # key and will not be served.
+    version_keys = models.Package.get_cache_version_keys(
+        index_slugs, package_name)
+    version = models.Package.get_cache_version_hash(
+        version_keys, cache.get_many(version_keys))
+
+    links = get_links(indexes, platform, package_name)
+    if links is None:
+        return version, None
+
+    render = PAGE_RENDERERS[namespace]
+    content = compress(render(package_name, platform, links).encode('utf-8'))
+
+    if store:
+        cache.set(models.Package.format_cache_key(
+            namespace, index_slugs, platform.slug, package_name, version,
+        ), content, timeout=None)
+        record_variant([
+            models.Package.get_pages_variants_key(index_slug, package_name)
+            for index_slug in index_slugs
+        ], (tuple(index_slugs), platform.slug, namespace))
+
+    return version, content
+
+
+def record_variant(keys, variant):
+    """
+    Remembers that the given variant of a page was recently served, under
+    all the given keys.
+    """
+    variants = cache.get_many(keys)
+    cache.set_many({
+        key: variants.get(key, frozenset()) | {variant}
+        for key in keys
+    }, timeout=settings.PAGE_VARIANTS_TIMEOUT)
+
+
+def get_indexes(index_slugs):
+    indexes = models.BackingIndex.objects.filter(slug__in=index_slugs)
+    indexes = {index.slug: index for index in indexes}
+    return [indexes[slug] for slug in index_slugs]
+
+
+def regenerate_pages(index_slug, package_name):
+    """
+    Renders again all the recently served pages listing the given package.
+    """
+    variants = cache.get(
+        models.Package.get_pages_variants_key(index_slug, package_name),
+    )
+    if not variants:
+        return
+
+    for index_slugs, platform_slug, namespace in variants:
+        try:
+            indexes = get_indexes(index_slugs)
+            platform = models.Platform.objects.get(slug=platform_slug)
+        except (KeyError, models.Platform.DoesNotExist):
+            continue
+        build_page(indexes, platform, package_name, namespace=namespace)
+
+
+def get_root_key(index_slugs, version, namespace=ROOT_NAMESPACE):
+    return '{}/indexes:{}/v:{}'.format(
+        namespace,
+        '+'.join(index_slugs),
+        version,
+    )
+
+
+def get_root_version_keys(index_slugs):
+    return sorted([
+        models.BackingIndex.get_root_version_key(index_slug)
+        for index_slug in index_slugs
+    ])
+
+
+def get_root(index_slugs, client_versions=(), local_cache=local_cache,
+             namespace=ROOT_NAMESPACE):
+    """
+    Returns the current version of the root listing for the given indexes
+    along with its compressed content, ``None`` if it was not generated yet
+    or ``NOT_MODIFIED`` if the client already has the current version.
+    """
+    return get_versioned(
+        get_root_key(index_slugs, VERSION_PLACEHOLDER, namespace),
+        get_root_version_keys(index_slugs),
+        client_versions=client_versions,
+        local_cache=local_cache,
+    )
+
+
+def render_html_root(index_slugs, projects):
+    # Rendering hundreds of thousands of links through the template engine
+    # is too slow, the list is built beforehand.
+    links = ''.join(
+        '<a href="{0}/">{0}</a><br />\n'.format(escape(project))
+        for project in projects
+    )
+    return render_to_string('wheelsproxy/root.html', {
+        'index_slugs': index_slugs,
+        'links': mark_safe(links),
+    })
+
+
+def render_json_root(index_slugs, projects):
+    return json.dumps({
+        'meta': {'api-version': SIMPLE_API_VERSION},
+        'projects': [{'name': project} for project in projects],
+    }, separators=(',', ':'))
+
+
+ROOT_RENDERERS = {
+    ROOT_NAMESPACE: render_html_root,
+    ROOT_JSON_NAMESPACE: render_json_root,
+}
+
+
+def build_root(indexes, store=True, namespace=ROOT_NAMESPACE):
+    """
+    Renders and compresses the listing of all the packages in the given
+    indexes. Returns the version of the listing along with its content.
+    """
+    index_slugs = [index.slug for index in indexes]
+
+    # Initializing the set of packages of an index expires the listing, do
+    # it before resolving the key.
+    for index in indexes:
+        if not cache.has_key(index.get_projects_key()):
+            index.update_projects()
+
+    version_keys = get_root_version_keys(index_slugs)
+    version = models.Package.get_cache_version_hash(
+        version_keys, cache.get_many(version_keys))
+
+    projects = set()
+    for index in indexes:
+        projects |= index.get_projects()
+
+    render = ROOT_RENDERERS[namespace]
+    content = compress(
+        render(index_slugs, sorted(projects)).encode('utf-8'))
+
+    if store:
+        cache.set(get_root_key(index_slugs, version, namespace), content,
+                  timeout=None)
+        record_variant([
+            models.BackingIndex.get_root_variants_key(index_slug)
+            for index_slug in index_slugs
+        ], (tuple(index_slugs), namespace))
+
+    return version, content
+
+
+def regenerate_root_pages(index_slug):
+    """
+    Renders again all the recently served root listings including the
+    given index.
+    """
+    variants = cache.get(models.BackingIndex.get_root_variants_key(index_slug))
+    if not variants:
+        return
+
+    for index_slugs, namespace in variants:
+        try:
+            indexes = get_indexes(index_slugs)
+        except KeyError:
+            continue
+        build_root(indexes, namespace=namespace)
+
+
+def accepts_gzip(request):
+    return bool(ACCEPTS_GZIP.search(
+        request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+
+def negotiate_content_type(request):
+    """
+    Returns the content type of the simple API representation preferred
+    by the client, as described in PEP 691. Defaults to HTML.
+    """
+    accept = request.META.get('HTTP_ACCEPT')
+    if not accept:
+        return HTML_CONTENT_TYPE
+
+    best, best_quality = None, 0
+
+    for media_range in accept.split(','):
+        media_type, _, params = media_range.partition(';')
+        media_type = media_type.strip().lower()
+        if media_type not in CONTENT_TYPES:
+            continue
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        if quality > best_quality:
+            best, best_quality = CONTENT_TYPES[media_type], quality
+
+    return best or HTML_CONTENT_TYPE
+
+
+def get_etag(namespace, version, gzipped):
+    # Compressed and uncompressed responses are different representations
+    # and need different strong ETags.
+    return quote_etag('{}-{}{}'.format(
+        namespace,
+        version.replace(',', '.'),
+        '-gzip' if gzipped else '',
+    ))
+
+
+def get_client_versions(request, namespace):
+    """
+    Returns the versions of the response the client already has for the
+    negotiated representation, as sent in ``If-None-Match``.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header:
+        return []
+
+    prefix = namespace + '-'
+    suffix = '-gzip' if accepts_gzip(request) else ''
+
+    versions = []
+    for etag in parse_etags(header):
+        if etag == ANY_VERSION:
+            versions.append(ANY_VERSION)
+        elif etag.startswith(prefix) and etag.endswith(suffix):
+            version = etag[len(prefix):len(etag) - len(suffix)]
+            versions.append(version.replace('.', ','))
+
+    return versions
+
+
+def patch_response_headers(request, response, namespace, version):
+    gzipped = accepts_gzip(request)
+    response['ETag'] = get_etag(namespace, version, gzipped)
+    patch_cache_control(
+        response,
+        public=True,
+        max_age=settings.SIMPLE_MAX_AGE,
+    )
+    patch_vary_headers(response, ('Accept', 'Accept-Encoding'))
+    return response
+
+
+def not_modified_response(request, namespace, version):
+    return patch_response_headers(
+        request, HttpResponseNotModified(), namespace, version)
+
+
+def page_response(request, content, version, namespace=PAGES_NAMESPACE,
+                  content_type=HTML_CONTENT_TYPE):
+    if accepts_gzip(request):
+        response = HttpResponse(content, content_type=content_type)
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(gzip.decompress(content),
+                                content_type=content_type)
+    response['Content-Length'] = str(len(response.content))
+    return patch_response_headers(request, response, namespace, version)
@@ -21,6 +21,19 @@ class AppSettings(Settings):
     TEMP_BUILD_ROOT = Value(str, default='/tmp')
     COMPILE_CACHE_ROOT = Value(str, default='/cache')
     MAX_CACHE_BUSTING_RETRIES = Value(int, default=3)
+    SYNC_CONCURRENCY = Value(int, default=1)
+    INDEX_MAX_CONNECTIONS = Value(int, default=10)
+    INDEX_REQUEST_TIMEOUT = Value(int, default=60)
+    DEVPI_CHANGELOG_WINDOW = Value(int, default=10)
+    PAGE_VARIANTS_TIMEOUT = Value(int, default=60 * 60 * 24 * 7)
+    PAGES_LOCAL_CACHE_SIZE = Value(int, default=32 * 1024 * 1024)
+    # Seconds between the logs of the local pages cache stats, 0 to disable
+    PAGES_LOCAL_CACHE_STATS_INTERVAL = Value(int, default=60 * 5)
+    SIMPLE_MAX_AGE = Value(int, default=60)
+    # Set to wheelsproxy.depgraph.BacktrackingDependencyGraph to backtrack
+    # on conflicts, at the cost of building the explored releases.
+    DEPENDENCY_RESOLVER = Value(
+        str, default='wheelsproxy.depgraph.DependencyGraph')
 
     RAVEN_CONFIG = Dictionary({
         'dsn': Value(str, key='SENTRY_DSN', default=None),
@@ -36,22 +36,31 @@ def import_packages(index_id, package_names):
     from . import models
     index = models.BackingIndex.objects.get(pk=index_id)
     succeded, failed, ignored = {}, {}, []
-    for package_name in package_names:
-        try:
-            id = index.import_package(package_name)
-        except Exception as e:
-            log.exception('Failed to import {} from {}'.format(
-                package_name, index.url))
+    for package_name, id, e in index.import_packages(package_names):
+        if e is not None:
+            log.error('Failed to import {} from {}'.format(
+                package_name, index.url), exc_info=e)
             failed[package_name] = '{}.{}: {}'.format(
                 e.__class__.__module__, e.__class__.__name__, str(e))
+        elif id:
+            succeded[package_name] = id
         else:
-            if id:
-                succeded[package_name] = id
-            else:
-                ignored.append(package_name)
+            ignored.append(package_name)
     return succeded, ignored, failed
 
 
+@shared_task(ignore_result=True)
+def regenerate_package_pages(index_slug, package_name):
+    from . import pages
+    pages.regenerate_pages(index_slug, package_name)
+
+
+@shared_task(ignore_result=True)
+def regenerate_root_pages(index_slug):
+    from . import pages
+    pages.regenerate_root_pages(index_slug)
+
+
 @shared_task(ignore_result=True)
 def sync_index(index_id):
     from . import models
@@ -0,0 +1,150 @@
+import io
+import os
+import hashlib
+import zipfile
+
+import mock
+import pytest
+
+from wheelsproxy import builder, client, models, utils
+
+from .test_client import RangeSession
+
+
+def make_wheel(files):
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w') as z:
+        for name, content in files.items():
+            z.writestr(name, content)
+    buf.seek(0)
+    return buf
+
+
+def test_extract_wheel_metadata_file():
+    metadata = b'Metadata-Version: 2.1\nName: dist-a\nVersion: 1.0\n'
+    wheel = make_wheel({
+        'dist_a/__init__.py': b'',
+        'dist_a/METADATA': b'Not the metadata',
+        'dist_a-1.0.dist-info/METADATA': metadata,
+        'dist_a-1.0.dist-info/RECORD': b'',
+    })
+    assert builder.extract_wheel_metadata_file(wheel) == metadata
+
+    wheel = make_wheel({'dist_a/__init__.py': b''})
+    assert builder.extract_wheel_metadata_file(wheel) is None
+
+
+def test_parse_wheel_metadata():
+    metadata = builder.parse_wheel_metadata(
+        b'Metadata-Version: 2.1\n'
+        b'Name: dist-a\n'
+        b'Version: 1.0\n'
+        b'Requires-Python: >=3.5\n'
+        b'Requires-Dist: six (>=1.10)\n'
+        b'Requires-Dist: enum34; python_version < "3.4"\n'
+        b'Requires-Dist: pytest; extra == "Tests"\n'
+        b'Requires-Dist: mock; "Test.Utils" == extra or os_name == "nt"\n'
+        b'Provides-Extra: Tests\n'
+        b'\n'
+        b'Requires-Dist: not-a-header\n'
+    )
+    assert metadata == {
+        'metadata_version': '2.1',
+        'requires_python': '>=3.5',
+        'provides_extra': ['tests'],
+        'requires_dist': [
+            ['six>=1.10', None],
+            ['enum34', 'python_version < "3.4"'],
+            ['pytest', 'extra == "tests"'],
+            ['mock', '"test.utils" == extra or os_name == "nt"'],
+        ],
+    }
+
+
+def test_extract_remote_wheel_metadata_file():
+    metadata = b'Metadata-Version: 2.1\nName: dist-a\nVersion: 1.0\n'
+    files = {'dist_a-1.0.dist-info/METADATA': metadata}
+    files.update({
+        'dist_a/module_{}.py'.format(i): os.urandom(1024)
+        for i in range(100)
+    })
+    session = RangeSession(make_wheel(files).getvalue())
+
+    with client.RemoteFile('https://files.example.com/dist_a-1.0.whl',
+                           session=session, block_size=16 * 1024) as fh:
+        assert builder.extract_wheel_metadata_file(fh) == metadata
+    # Only the central directory and the METADATA member are downloaded
+    assert len(session.ranges) <= 3
+
+
+def test_mirror_wheel(db, settings, tmpdir):
+    settings.TEMP_BUILD_ROOT = str(tmpdir)
+    metadata = b'Metadata-Version: 2.1\nName: dist-a\nRequires-Dist: six\n'
+    content = make_wheel({
+        'dist_a-1.0.dist-info/METADATA': metadata,
+    }).getvalue()
+
+    index = models.BackingIndex.objects.create(
+        slug='test', url='https://example.com')
+    release = index.get_package('dist-a').release_set.create(
+        version='1.0',
+        url='https://example.com/dist_a-1.0-py2.py3-none-any.whl',
+        md5_digest=hashlib.md5(content).hexdigest(),
+    )
+    platform = models.Platform.objects.create(
+        slug='platform', type='docker',
+        environment={'python_version': '3.6'},
+    )
+    build = release.get_build(platform)
+
+    response = mock.MagicMock()
+    response.__enter__.return_value.iter_content.return_value = [
+        content[:10], content[10:],
+    ]
+    session = mock.Mock(**{'get.return_value': response})
+    with mock.patch.object(client, 'get_files_session',
+                           return_value=session), \
+            mock.patch.object(models.Platform, 'get_builder') as get_builder:
+        build.rebuild()
+    assert not get_builder.called
+
+    build.refresh_from_db()
+    assert build.is_built()
+    assert build.filename == 'dist_a-1.0-py2.py3-none-any.whl'
+    assert build.md5_digest == release.md5_digest
+    assert build.metadata['requires_dist'] == [['six', None]]
+    assert build.has_metadata_file()
+    build.build.open()
+    assert build.build.read() == content
+
+    release.md5_digest = 'a' * 32
+    with pytest.raises(RuntimeError):
+        builder.mirror_wheel(build, session=session)
+
+
+def test_is_pure_wheel():
+    cpython36 = {'python_version': '3.6', 'implementation_name': 'cpython'}
+    pypy27 = {'python_version': '2.7', 'implementation_name': 'pypy'}
+
+    def pure(filename, environment):
+        return utils.is_pure_wheel(
+            'https://files.example.com/packages/' + filename, environment)
+
+    assert pure('dist_a-1.0-py2.py3-none-any.whl', cpython36)
+    assert pure('dist_a-1.0-py2.py3-none-any.whl', pypy27)
+    assert pure('dist_a-1.0-1-py3-none-any.whl', cpython36)
+    assert pure('dist_a-1.0-py35-none-any.whl', cpython36)
+    assert pure('dist_a-1.0-cp36-none-any.whl', cpython36)
+
+    assert not pure('dist_a-1.0-py3-none-any.whl', pypy27)
+    assert not pure('dist_a-1.0-py2-none-any.whl', cpython36)
+    assert not pure('dist_a-1.0-py37-none-any.whl', cpython36)
+    assert not pure('dist_a-1.0-cp35-none-any.whl', cpython36)
+    assert not pure('dist_a-1.0-cp27-none-any.whl', pypy27)
+    assert not pure('dist_a-1.0-cp36-cp36m-any.whl', cpython36)
+    assert not pure('dist_a-1.0-py3-none-linux_x86_64.whl', cpython36)
+    assert not pure('dist-a-1.0.tar.gz', cpython36)
+    assert not pure('', cpython36)
+
+    # Without a known interpreter, the wheel has to be built
+    assert not pure('dist_a-1.0-py2.py3-none-any.whl', None)
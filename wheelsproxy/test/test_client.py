@@ -0,0 +1,306 @@
+import io
+import json
+import time
+import random
+import threading
+
+import mock
+import pytest
+
+from execnet.gateway_base import dumps_internal
+
+from wheelsproxy import client
+
+
+class FakeClient(client.IndexAPIClient):
+    def __init__(self, url):
+        super(FakeClient, self).__init__(url)
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+        self.barrier = threading.Event()
+
+    def get_package_releases(self, package_name, ensure_serial=None,
+                             validators=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+            if self.running > 1:
+                self.barrier.set()
+        self.barrier.wait(1)
+        with self.lock:
+            self.running -= 1
+        if package_name == 'missing':
+            raise client.PackageNotFound()
+        return {'1.0': [client.Release(package_name, '', 'sdist')]}
+
+
+def test_iter_package_releases(settings):
+    settings.INDEX_MAX_CONNECTIONS = 4
+    fake = FakeClient('https://index.example.com')
+
+    results = {
+        package_name: (releases, error)
+        for package_name, releases, error
+        in fake.iter_package_releases(['dist-a', 'dist-b', 'missing'])
+    }
+
+    assert fake.max_running > 1
+    assert results['dist-a'][0]['1.0'][0].url == 'dist-a'
+    assert results['dist-b'][1] is None
+    assert isinstance(results['missing'][1], client.PackageNotFound)
+
+
+def test_devpi_changelog_window(settings):
+    settings.DEVPI_CHANGELOG_WINDOW = 5
+    devpi = client.DevPIClient('https://devpi.example.com/root/pypi')
+    devpi.supports_changelog_ranges = False
+
+    def fetch_event(changelog_url, serial, headers):
+        time.sleep(random.uniform(0, 0.01))
+        return {'root/pypi/dist-{}'.format(serial): serial}
+
+    with mock.patch.object(devpi, '_fetch_changelog_event', fetch_event):
+        events = list(devpi._iter_changelog(None, 3, 42, {}))
+
+    assert [serial for serial, event in events] == list(range(3, 43))
+    assert all(
+        event == {'root/pypi/dist-{}'.format(serial): serial}
+        for serial, event in events
+    )
+
+
+def test_devpi_changelog_range_stream():
+    devpi = client.DevPIClient('https://devpi.example.com/root/pypi')
+    changes = [
+        (serial, {'root/pypi/dist-{}'.format(serial): serial})
+        for serial in range(5, 10)
+    ]
+    payload = b''.join(
+        dumps_internal(obj)
+        for serial, event in changes
+        for obj in (serial, (event, []))
+    )
+    response = mock.Mock(
+        raw=io.BytesIO(payload),
+        headers={'content-type': client.DEVPI_STREAMING_CHANGES},
+    )
+
+    with mock.patch.object(devpi, '_fetch_changelog_range',
+                           return_value=response) as fetch_range:
+        events = list(devpi._iter_changelog(None, 5, 8, {}))
+
+    fetch_range.assert_called_once_with(None, 5, {})
+    assert events == changes[:4]
+    assert response.close.called
+
+
+def test_devpi_changelog_range_list():
+    devpi = client.DevPIClient('https://devpi.example.com/root/pypi')
+    changes = [
+        (serial, {'root/pypi/dist-{}'.format(serial): serial})
+        for serial in range(5, 10)
+    ]
+
+    def response(payload):
+        return mock.Mock(
+            raw=io.BytesIO(dumps_internal(payload)),
+            headers={'content-type': 'application/octet-stream'},
+        )
+
+    # As sent by devpi-server, with the renames already dropped
+    with mock.patch.object(devpi, '_fetch_changelog_range',
+                           return_value=response(changes)):
+        assert list(devpi._iter_changelog(None, 5, 9, {})) == changes
+
+    # Full (changes, renames) entries are unwrapped
+    entries = [(serial, (event, [])) for serial, event in changes]
+    with mock.patch.object(devpi, '_fetch_changelog_range',
+                           return_value=response(entries)):
+        assert list(devpi._iter_changelog(None, 5, 9, {})) == changes
+
+
+def test_devpi_changelog_range_fallback():
+    devpi = client.DevPIClient('https://devpi.example.com/root/pypi')
+
+    with mock.patch.object(devpi, '_fetch_changelog_range',
+                           return_value=None), \
+            mock.patch.object(devpi, '_fetch_changelog_event',
+                              side_effect=lambda url, serial, h: serial):
+        events = list(devpi._iter_changelog(None, 1, 3, {}))
+
+    assert events == [(1, 1), (2, 2), (3, 3)]
+    assert not devpi.supports_changelog_ranges
+
+
+def test_pypi_conditional_request(settings):
+    settings.MAX_CACHE_BUSTING_RETRIES = 0
+    pypi = client.PyPIClient('https://pypi.example.com/pypi')
+    validators = {'etag': '"abc"', 'last_modified': None, 'size': 1234}
+    response = mock.Mock(status_code=304, headers={
+        'X-PyPI-Last-Serial': '10',
+    })
+
+    with mock.patch.object(pypi.session, 'get',
+                           return_value=response) as get:
+        with pytest.raises(client.NotModified):
+            pypi.get_package_releases(
+                'dist-a',
+                ensure_serial=10,
+                validators=validators,
+            )
+
+    assert get.call_args[1]['headers'] == {'If-None-Match': '"abc"'}
+    assert pypi.bytes_saved == 1234
+
+
+def test_pypi_conditional_request_without_serial(settings):
+    settings.MAX_CACHE_BUSTING_RETRIES = 0
+    pypi = client.PyPIClient('https://pypi.example.com/pypi')
+    validators = {'etag': '"abc"', 'last_modified': None, 'size': 1234}
+    not_modified = mock.Mock(status_code=304, headers={})
+    content = json.dumps({
+        'info': {'description': '', 'classifiers': []},
+        'releases': {'1.0': []},
+    }).encode('utf-8')
+    response = mock.Mock(status_code=200, content=content, headers={
+        'X-PyPI-Last-Serial': '10',
+        'ETag': '"def"',
+    })
+
+    # The serial of a 304 without X-PyPI-Last-Serial can't be checked, the
+    # document is fetched again without conditional headers.
+    with mock.patch.object(pypi.session, 'get',
+                           side_effect=[not_modified, response]) as get:
+        releases = pypi.get_package_releases(
+            'dist-a',
+            ensure_serial=10,
+            validators=validators,
+        )
+
+    assert releases == {'1.0': []}
+    assert releases.validators['etag'] == '"def"'
+    assert [c[1]['headers'] for c in get.call_args_list] == [
+        {'If-None-Match': '"abc"'},
+        {},
+    ]
+    assert pypi.bytes_saved == 0
+
+    # Stale unconditional responses are still retried
+    stale = mock.Mock(status_code=200, content=content, headers={
+        'X-PyPI-Last-Serial': '9',
+    })
+    with mock.patch.object(pypi.session, 'get',
+                           side_effect=[not_modified, stale]):
+        with pytest.raises(RuntimeError):
+            pypi.get_package_releases(
+                'dist-a',
+                ensure_serial=10,
+                validators=validators,
+            )
+
+
+def test_pypi_decode_releases():
+    pypi = client.PyPIClient('https://pypi.example.com/pypi')
+    file_entry = {
+        'url': 'https://files.example.com/dist-a-1.0.tar.gz',
+        'md5_digest': '0' * 32,
+        'packagetype': 'sdist',
+        'digests': {'md5': '0' * 32, 'sha256': '1' * 64},
+        'size': 1234,
+    }
+    content = json.dumps({
+        'info': {'description': 'A' * 1000, 'classifiers': []},
+        'last_serial': 10,
+        'releases': {'1.0': [file_entry], '2.0': []},
+        'urls': [file_entry],
+    }).encode('utf-8')
+
+    assert pypi._decode_releases(content) == {
+        '1.0': [client.Release(
+            'https://files.example.com/dist-a-1.0.tar.gz',
+            '0' * 32,
+            'sdist',
+        )],
+        '2.0': [],
+    }
+
+
+def test_pypi_simple_updated_packages():
+    pypi = client.PyPISimpleClient('https://pypi.example.com/pypi')
+    assert pypi.simple_url.url == 'https://pypi.example.com/simple/'
+
+    def simple_index(*projects):
+        return {
+            'meta': {'api-version': '1.0', '_last-serial': 20},
+            'projects': [
+                {'name': name, '_last-serial': serial}
+                for name, serial in projects
+            ],
+        }
+
+    with mock.patch.object(pypi, '_get_simple_index', return_value=(
+            simple_index(('dist-a', 5), ('dist-b', 7), ('dist-c', 3)))):
+        assert list(pypi.iter_updated_packages(4)) == [
+            ('dist-a', 5),
+            ('dist-b', 7),
+        ]
+
+    with mock.patch.object(pypi, '_get_simple_index', return_value=(
+            simple_index(('dist-a', 5), ('dist-b', 12), ('dist-d', 9)))):
+        assert list(pypi.iter_updated_packages(7)) == [
+            ('dist-c', 7),
+            ('dist-d', 9),
+            ('dist-b', 12),
+        ]
+
+
+class RangeSession(object):
+    """
+    Serves the given content, honouring the ``Range`` header of requests.
+    """
+
+    def __init__(self, content, supports_ranges=True):
+        self.content = content
+        self.supports_ranges = supports_ranges
+        self.ranges = []
+
+    def get(self, url, headers, stream):
+        byte_range = headers['Range'][len('bytes='):]
+        self.ranges.append(byte_range)
+        if not self.supports_ranges:
+            return mock.Mock(status_code=200, content=self.content)
+        start, end = byte_range.split('-')
+        if not start:
+            start, end = max(len(self.content) - int(end), 0), None
+        else:
+            start, end = int(start), int(end) + 1
+        content = self.content[start:end]
+        return mock.Mock(status_code=206, content=content, headers={
+            'Content-Range': 'bytes {}-{}/{}'.format(
+                start, start + len(content) - 1, len(self.content)),
+        })
+
+
+def test_remote_file():
+    content = bytes(bytearray(random.getrandbits(8) for _ in range(1000)))
+    session = RangeSession(content)
+    fh = client.RemoteFile('https://files.example.com/dist.whl',
+                           session=session, block_size=100)
+    assert fh.size == 1000
+    assert session.ranges == ['-100']
+
+    fh.seek(-50, io.SEEK_END)
+    assert fh.read() == content[-50:]
+    fh.seek(10)
+    assert fh.read(20) == content[10:30]
+    assert fh.read(20) == content[30:50]
+    assert fh.tell() == 50
+    assert session.ranges == ['-100', '10-109']
+
+    fh.seek(2000)
+    assert fh.read(10) == b''
+
+    with pytest.raises(client.RangeRequestsNotSupported):
+        client.RemoteFile('https://files.example.com/dist.whl',
+                          session=RangeSession(content, False))
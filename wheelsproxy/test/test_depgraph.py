@@ -1,5 +1,4 @@
 import random
-from functools import partial
 
 import attr
 
@@ -8,6 +7,8 @@ import pytest
 from pkg_resources import parse_version, Requirement
 
 from django.core.exceptions import ObjectDoesNotExist
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from wheelsproxy import depgraph, utils, models
 
@@ -40,7 +41,8 @@ class Distribution(object):
 class Release(object):
     distribution = attr.ib()
     version = attr.ib(convert=parse_version)
-    requirements = attr.ib(convert=partial(map, Requirement), default=[])
+    requirements = attr.ib(
+        convert=lambda reqs: list(map(Requirement, reqs)), default=[])
 
     def get_build(self, platform):
         return Build(self, platform)
@@ -76,6 +78,10 @@ class Build(object):
     def is_external(self):
         return False
 
+    @property
+    def package_name(self):
+        return self.release.distribution
+
     def iter_requirements(self, extras=None):
         return iter(self.release.requirements)
 
@@ -102,6 +108,14 @@ class Index(object):
             else:
                 raise ObjectDoesNotExist('Distribution not found')
 
+    def get_candidates(self, package_names):
+        candidates = {}
+        for package_name in package_names:
+            key = utils.normalize_package_name(package_name)
+            if key in self.distributions:
+                candidates[key] = self.distributions[key].get_versions()
+        return candidates
+
     def to_db(self):
         index = models.BackingIndex.objects.create(
             slug='{}-{}'.format(self.slug, random.randint(0, 9999)),
@@ -113,11 +127,13 @@ class Index(object):
 
 
 class Platform(object):
-    pass
+    def get_builds(self, releases):
+        return [release.get_build(self) for release in releases]
 
 
-def simple_compile(distributions, requirements):
-    graph = depgraph.DependencyGraph(
+def simple_compile(distributions, requirements,
+                   graph_class=depgraph.DependencyGraph):
+    graph = graph_class(
         [Index(distributions)],
         Platform(),
     )
@@ -164,7 +180,11 @@ def simple_compile(distributions, requirements):
 #     pass
 
 
-def test_compile():
+@pytest.mark.parametrize('graph_class', [
+    depgraph.DependencyGraph,
+    depgraph.BacktrackingDependencyGraph,
+])
+def test_compile(graph_class):
     graph = simple_compile([
         Release('dist-a', '1.0', ['dist-c']),
         Release('dist-b', '2.0', ['dist-e']),
@@ -175,7 +195,7 @@ def test_compile():
     ], [
         'dist-a',
         'dist-b',
-    ])
+    ], graph_class)
 
     assert 'dist-a' in graph
     assert 'dist-b==2.0' in graph
@@ -185,6 +205,109 @@ def test_compile():
     assert 'dist-d' not in graph
 
 
+def test_remove_orphaned_cascade():
+    graph = simple_compile([
+        Release('dist-a', '2.0', ['dist-x']),
+        Release('dist-a', '1.0'),
+        Release('dist-b', '1.0', ['dist-a<2']),
+        Release('dist-x', '1.0', ['dist-y']),
+        Release('dist-y', '1.0'),
+    ], [
+        'dist-a',
+        'dist-b',
+    ])
+
+    assert 'dist-a==1.0' in graph
+    assert 'dist-x' not in graph
+    assert 'dist-y' not in graph
+    assert len(graph) == 2
+
+
+def test_merge_requirements():
+    merged = depgraph.merge_requirements(
+        Requirement.parse('dist[foo]>=1.0'),
+        Requirement.parse('Dist[bar]<2,!=1.5'),
+    )
+    assert merged == Requirement.parse('dist[bar,foo]>=1.0,<2,!=1.5')
+    # Merging the same requirements returns the same instance
+    assert merged is depgraph.merge_requirements(
+        Requirement.parse('dist[foo]>=1.0'),
+        Requirement.parse('Dist[bar]<2,!=1.5'),
+    )
+
+
+def test_compile_backtracking():
+    distributions = [
+        Release('dist-a', '2.0', ['dist-b', 'dist-c']),
+        Release('dist-a', '1.0'),
+        Release('dist-b', '1.0', ['dist-d<2']),
+        Release('dist-c', '1.0', ['dist-d>=2']),
+        Release('dist-d', '2.0'),
+        Release('dist-d', '1.0'),
+    ]
+
+    with pytest.raises(depgraph.UnsatisfiedDependency):
+        simple_compile(distributions, ['dist-a'])
+
+    graph = simple_compile(distributions, ['dist-a'],
+                           depgraph.BacktrackingDependencyGraph)
+    assert len(graph) == 1
+    assert 'dist-a==1.0' in graph
+
+    graph = simple_compile(distributions, ['dist-a', 'dist-d<2'],
+                           depgraph.BacktrackingDependencyGraph)
+    assert 'dist-a==1.0' in graph
+
+    with pytest.raises(depgraph.UnsatisfiedDependency):
+        simple_compile(distributions, ['dist-a>1', 'dist-d<2'],
+                       depgraph.BacktrackingDependencyGraph)
+
+
+def test_backtracking_same_output():
+    distributions = [
+        Release('dist-a', '1.0', ['dist-c', 'setuptools']),
+        Release('dist-b', '2.0', ['dist-c<2']),
+        Release('dist-c', '2.0'),
+        Release('dist-c', '1.0'),
+        Release('setuptools', '40.0'),
+    ]
+    formatter = depgraph.GraphFormatter()
+    assert formatter.format(
+        simple_compile(distributions, ['dist-a', 'dist-b']),
+    ) == formatter.format(simple_compile(
+        distributions, ['dist-a', 'dist-b'],
+        depgraph.BacktrackingDependencyGraph,
+    ))
+
+
+@pytest.mark.parametrize('graph_class', [
+    depgraph.DependencyGraph,
+    depgraph.BacktrackingDependencyGraph,
+])
+def test_compile_preferred(graph_class):
+    distributions = [
+        Release('dist-a', '2.0', ['dist-c']),
+        Release('dist-a', '1.0', ['dist-c']),
+        Release('dist-b', '1.0', ['dist-c>=2']),
+        Release('dist-c', '3.0'),
+        Release('dist-c', '2.0'),
+        Release('dist-c', '1.0'),
+    ]
+    graph = graph_class([Index(distributions)], Platform())
+
+    graph.compile('dist-a', preferred={'dist-a': '1.0', 'Dist-C': '1.0'})
+    assert 'dist-a==1.0' in graph
+    assert 'dist-c==1.0' in graph
+
+    # Incompatible preferred versions are replaced
+    graph.compile('dist-a\ndist-b', preferred={
+        'dist-a': '1.0',
+        'dist-c': '1.0',
+    })
+    assert 'dist-a==1.0' in graph
+    assert 'dist-c==3.0' in graph
+
+
 def test_merge_incompatible_url_requirement():
     with pytest.raises(depgraph.IncompatibleRequirements):
         depgraph.merge_requirements(
@@ -217,3 +340,33 @@ def test_find_best_release_multiindex_same_version():
 
     rel = depgraph.find_best_release(indexes, Requirement.parse('dist-a'))
     assert rel.package.index == indexes[0]
+
+
+@pytest.mark.django_db
+def test_compile_batched_queries():
+    platform = models.Platform.objects.create(
+        slug='platform', type='docker', environment={})
+
+    def compile_fanout(count):
+        index = models.BackingIndex.objects.create(
+            slug='fanout-{}'.format(count), url='https://example.com')
+        names = ['dist-{}'.format(i) for i in range(count)]
+        requirements = {'root': names, 'leaf': []}
+        requirements.update({name: ['leaf'] for name in names})
+        for name, requires in requirements.items():
+            release = index.get_package(name).release_set.create(
+                version='1.0')
+            build = release.get_build(platform)
+            build.metadata = {
+                'requires_dist': [[r, None] for r in requires],
+            }
+            build.save()
+
+        graph = depgraph.DependencyGraph([index], platform)
+        with CaptureQueriesContext(connection) as queries:
+            graph.compile('root')
+        assert len(graph) == count + 2
+        return len(queries)
+
+    # The number of queries does not depend on the number of packages
+    assert compile_fanout(5) == compile_fanout(50)
@@ -1,6 +1,15 @@
+import io
 import os
+import time
+import zipfile
 
-from wheelsproxy import models
+import mock
+import pytest
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from wheelsproxy import models, client, builder
 
 
 def test_upload_external_build_to():
@@ -31,3 +40,285 @@ def test_ordering_same_normalized_version():
     ]
 
     assert sorted(sorting_tuple, key=lambda t: t[0]) == sorting_tuple
+
+
+def test_concurrent_sync_checkpoint_order():
+    events = [
+        ('dist-a', 1),
+        ('dist-b', 2),
+        (None, 3),
+        ('dist-a', 4),
+        ('dist-c', 5),
+    ]
+    imported = []
+
+    def sync_package(package_name, serial):
+        # Let later events finish first
+        time.sleep(0.01 * (6 - serial))
+        imported.append((package_name, serial))
+
+    index = models.BackingIndex(slug='test', last_update_serial=0)
+    index.client = mock.Mock(**{
+        'iter_updated_packages.return_value': iter(events),
+    })
+    with mock.patch.object(index, '_sync_package', sync_package), \
+            mock.patch.object(index, 'save'), \
+            mock.patch.object(index, 'update_projects') as update_projects:
+        serials = list(index.itersync(concurrency=4))
+
+    assert serials == [1, 2, 3, 4, 5]
+    assert index.last_update_serial == 5
+    assert sorted(imported) == sorted(e for e in events if e[0])
+    update_projects.assert_called_once_with({'dist-a', 'dist-b', 'dist-c'})
+    # Imports of the same package are never reordered
+    assert imported.index(('dist-a', 1)) < imported.index(('dist-a', 4))
+
+
+@pytest.mark.django_db
+def test_import_package_bulk_upsert():
+    def releases(versions, suffix=''):
+        return {
+            version: [client.Release(
+                'https://example.com/dist-a-{}{}.tar.gz'.format(
+                    version, suffix),
+                '',
+                'sdist',
+            )]
+            for version in versions
+        }
+
+    index = models.BackingIndex.objects.create(
+        slug='test', url='https://example.com')
+    index.client = mock.Mock()
+
+    index.client.get_package_releases.return_value = releases(
+        ['1.{}'.format(i) for i in range(100)])
+    with CaptureQueriesContext(connection) as initial:
+        package_id = index.import_package('dist-a')
+    assert models.Release.objects.filter(package=package_id).count() == 100
+
+    updated = releases(['1.{}'.format(i) for i in range(50, 150)])
+    updated.update(releases(['1.50', '1.51'], suffix='-fixed'))
+    index.client.get_package_releases.return_value = updated
+    with CaptureQueriesContext(connection) as update:
+        assert index.import_package('dist-a') == package_id
+
+    versions = dict(models.Release.objects
+                    .filter(package=package_id)
+                    .values_list('version', 'url'))
+    assert len(versions) == 100
+    assert '1.0' not in versions
+    assert versions['1.50'].endswith('-fixed.tar.gz')
+    assert versions['1.149'].endswith('1.149.tar.gz')
+
+    # The number of queries does not depend on the number of releases
+    assert len(initial) < 10
+    assert len(update) < 10
+
+
+@pytest.mark.django_db
+def test_simple_index_snapshot_is_stored_per_index():
+    index = models.BackingIndex.objects.create(
+        slug='test', url='https://example.com/pypi',
+        backend=models.INDEX_BACKENDS.PYPI_SIMPLE)
+    listing = {'projects': [{'name': 'dist-a', '_last-serial': 5}]}
+    with mock.patch.object(client.PyPISimpleClient, '_get_simple_index',
+                           return_value=listing):
+        assert list(index.get_client().iter_updated_packages(0)) == [
+            ('dist-a', 5),
+        ]
+
+    # A fresh client for the reloaded index still sees the removal
+    index = models.BackingIndex.objects.get(pk=index.pk)
+    assert index.load_snapshot() == {'dist-a': 5}
+    with mock.patch.object(client.PyPISimpleClient, '_get_simple_index',
+                           return_value={'projects': []}):
+        assert list(index.get_client().iter_updated_packages(5)) == [
+            ('dist-a', 5),
+        ]
+
+
+@pytest.mark.django_db
+def test_platform_get_builds_queries():
+    index = models.BackingIndex.objects.create(
+        slug='test', url='https://example.com')
+    for name in ['dist-a', 'dist-b']:
+        package = index.get_package(name)
+        package.default_setup_commands = 'setup-' + name
+        package.save()
+        for i in range(10):
+            package.release_set.create(
+                version='1.{}'.format(i),
+                url='https://example.com/{}-1.{}.tar.gz'.format(name, i),
+            )
+
+    def get_builds(platform_slug, releases):
+        platform = models.Platform.objects.create(
+            slug=platform_slug, type='docker')
+        releases = list(releases)
+        with CaptureQueriesContext(connection) as queries:
+            builds = platform.get_builds(releases)
+        assert [b.release for b in builds] == releases
+        assert all(
+            b.setup_commands == 'setup-' + b.release.package.slug
+            for b in builds
+        )
+        return len(queries)
+
+    releases = models.Release.objects.order_by('package__slug', 'version')
+    # The number of queries does not depend on the number of releases, nor
+    # on the number of packages they belong to
+    assert get_builds('one', releases.filter(version='1.0')) == get_builds(
+        'all', releases)
+
+
+def test_expire_index_cache_changes_package_keys():
+    args = ('simple', ['index-a', 'index-b'], 'platform', 'dist-a')
+    key = models.Package.get_cache_key(*args)
+
+    models.BackingIndex(slug='index-b').expire_cache()
+    expired_key = models.Package.get_cache_key(*args)
+    assert expired_key != key
+
+    models.Package.expire_packages_cache('index-a', ['dist-a', 'dist-b'])
+    assert models.Package.get_cache_key(*args) not in (key, expired_key)
+
+    # Unrelated packages are not affected by package-level expiration
+    other_args = ('simple', ['index-a'], 'platform', 'dist-c')
+    other_key = models.Package.get_cache_key(*other_args)
+    models.Package.expire_packages_cache('index-a', ['dist-a'])
+    assert models.Package.get_cache_key(*other_args) == other_key
+
+
+def test_iter_requirements():
+    platform = models.Platform(environment={'python_version': '2.7'})
+    build = models.Build(platform=platform, metadata={
+        'requires_dist': [
+            ['six>=1.10', None],
+            ['enum34', 'python_version < "3.4"'],
+            ['futures', 'python_version >= "3.4"'],
+            ['pytest', 'extra == "tests"'],
+        ],
+    })
+
+    def requirements(extras=None):
+        return [str(r) for r in build.iter_requirements(extras)]
+
+    assert requirements() == ['six>=1.10', 'enum34']
+    assert requirements(['tests']) == ['six>=1.10', 'enum34', 'pytest']
+
+    # Extra names are normalized in the stored markers
+    build.metadata = builder.parse_wheel_metadata(
+        b'Metadata-Version: 2.1\n'
+        b'Requires-Dist: pytest; extra == "Tests"\n'
+        b'Provides-Extra: Tests\n'
+    )
+    assert requirements() == []
+    assert requirements(['tests']) == ['pytest']
+    assert requirements(['Tests']) == ['pytest']
+
+    # The legacy metadata.json format is still supported
+    build.metadata = {
+        'run_requires': [
+            {'requires': ['six (>=1.10)']},
+            {'requires': ['pytest'], 'extra': 'tests'},
+            {'requires': ['enum34'], 'environment': 'python_version<"3.4"'},
+        ],
+    }
+    assert requirements() == ['six>=1.10', 'enum34']
+    assert [r.project_name for r in build.iter_requirements(['tests'])] == [
+        'six', 'pytest', 'enum34',
+    ]
+
+
+def test_fetch_metadata():
+    wheel = io.BytesIO()
+    with zipfile.ZipFile(wheel, 'w') as z:
+        z.writestr('dist_a-1.0.dist-info/METADATA', b'Requires-Dist: six\n')
+    wheel.seek(0)
+
+    platform = models.Platform(environment={
+        'python_version': '3.6', 'implementation_name': 'cpython'})
+    release = models.Release(url='https://example.com/dist-a-1.0.tar.gz')
+    build = models.Build(release=release, platform=platform)
+    with mock.patch.object(client, 'RemoteFile') as remote_file:
+        assert not build.fetch_metadata()
+    assert not remote_file.called
+
+    release.url = 'https://example.com/dist_a-1.0-py2.py3-none-any.whl'
+    with mock.patch.object(client, 'RemoteFile', return_value=wheel), \
+            mock.patch.object(build, 'save') as save:
+        assert build.fetch_metadata()
+    save.assert_called_once_with(update_fields=['metadata'])
+    assert build.metadata['requires_dist'] == [['six', None]]
+
+
+@pytest.mark.django_db
+def test_compiled_requirements_cache():
+    platform = models.Platform.objects.create(
+        slug='platform', type='docker', environment={})
+    index_slugs = ['index-a']
+    hash = models.CompiledRequirements.get_input_hash(
+        platform, index_slugs, 'dist-a\nDist-B>=1.0 # comment\n')
+    assert hash == models.CompiledRequirements.get_input_hash(
+        platform, index_slugs, '\nDist-B >= 1.0\ndist-a')
+    assert hash != models.CompiledRequirements.get_input_hash(
+        platform, ['index-a', 'index-b'], 'dist-a\nDist-B>=1.0')
+
+    compiled = models.CompiledRequirements.objects.create(
+        platform=platform,
+        requirements='dist-a\nDist-B>=1.0',
+        index_slugs=index_slugs,
+        input_hash=hash,
+        pip_compilation_status=models.COMPILATION_STATUSES.DONE,
+        pip_compiled_requirements=(
+            'dist-a==1.0\n'
+            'dist-b==2.0   # via dist-a\n'
+            'dist-c[security,tests]==3.0   # via dist-a\n'
+            '# setuptools==40.0\n'
+        ),
+    )
+
+    def get_cached():
+        return models.CompiledRequirements.objects.get_cached(
+            platform, index_slugs, 'dist-a\nDist-B>=1.0')
+
+    # Not yet recorded
+    assert get_cached() is None
+    compiled.record_consulted_packages(compiled.pip_compiled_requirements)
+    assert set(compiled.consulted_versions) == {'dist-a', 'dist-b', 'dist-c'}
+    assert get_cached() == compiled
+
+    # Changes to unrelated packages are ignored
+    models.Package.expire_packages_cache('index-a', ['dist-d'])
+    models.Package.expire_packages_cache('index-b', ['dist-a'])
+    assert get_cached() == compiled
+
+    models.Package.expire_packages_cache('index-a', ['dist-b'])
+    assert get_cached() is None
+
+    # Packages pinned with extras are recorded as well
+    compiled.record_consulted_packages(compiled.pip_compiled_requirements)
+    assert get_cached() == compiled
+    models.Package.expire_packages_cache('index-a', ['dist-c'])
+    assert get_cached() is None
+
+
+def test_compiled_requirements_pins():
+    compiled = models.CompiledRequirements(
+        internal_compilation_status=models.COMPILATION_STATUSES.DONE,
+        internal_compiled_requirements=(
+            '# header\n'
+            'https://example.com/dist-x.tar.gz#egg=dist-x==1.0\n'
+            'Dist_A==1.0.post1      # via dist-b\n'
+            'dist-b==2.0\n'
+            'dist-c[security]==3.0   # via dist-b\n'
+            '# setuptools==40.0\n'
+        ),
+    )
+    assert compiled.get_pins('internal') == {
+        'dist-a': '1.0.post1',
+        'dist-b': '2.0',
+        'dist-c': '3.0',
+    }
+    assert compiled.get_pins('pip') == {}
@@ -0,0 +1,341 @@
+import gzip
+import json
+import time
+
+import mock
+import pytest
+
+from django.core.cache import cache
+from django.db import connection
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from wheelsproxy import models, pages, utils, views
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # The database is rolled back after each test, the cache is not
+    cache.clear()
+
+
+@pytest.fixture
+def package(db):
+    index = models.BackingIndex.objects.create(
+        slug='test', url='https://example.com')
+    package = index.get_package('dist-a')
+    for i in range(20):
+        models.Release.objects.create(
+            package=package,
+            version='1.{}'.format(i),
+            url='https://example.com/dist-a-1.{}.tar.gz'.format(i),
+        )
+    return package
+
+
+@pytest.fixture
+def platform(db):
+    return models.Platform.objects.create(slug='platform', type='docker')
+
+
+def test_build_page(package, platform):
+    index = package.index
+
+    with CaptureQueriesContext(connection) as queries:
+        version, content = pages.build_page([index], platform, 'dist-a')
+    # Missing builds are created in bulk
+    assert models.Build.objects.filter(release__package=package).count() == 20
+    assert len(queries) < 10
+
+    page = gzip.decompress(content).decode('utf-8')
+    assert page.count('rel="internal"') == 20
+    assert 'dist-a-1.19.tar.gz' in page
+
+    with CaptureQueriesContext(connection) as queries:
+        cached = pages.get_page(['test'], 'platform', 'dist-a')
+    assert cached == (version, content)
+    assert not queries
+
+    assert pages.build_page([index], platform, 'dist-b')[1] is None
+
+
+def test_regenerate_on_change(transactional_db, package, platform):
+    # Regenerations are only scheduled once the transaction is committed
+    pages.build_page([package.index], platform, 'dist-a')
+
+    with mock.patch('wheelsproxy.tasks.regenerate_package_pages') as task:
+        package.expire_cache()
+    task.delay.assert_called_once_with('test', 'dist-a')
+    assert pages.get_page(['test'], 'platform', 'dist-a')[1] is None
+
+    pages.regenerate_pages('test', 'dist-a')
+    assert pages.get_page(['test'], 'platform', 'dist-a')[1] is not None
+
+
+def test_page_response():
+    content = pages.compress(b'<html></html>')
+    factory = RequestFactory()
+
+    response = pages.page_response(
+        factory.get('/', HTTP_ACCEPT_ENCODING='gzip, deflate'), content, '3')
+    assert response['Content-Encoding'] == 'gzip'
+    assert response['ETag'] == '"links-3-gzip"'
+    assert response.content == content
+
+    response = pages.page_response(factory.get('/'), content, '3')
+    assert not response.has_header('Content-Encoding')
+    assert response['ETag'] == '"links-3"'
+    assert response.content == b'<html></html>'
+    assert response['Vary'] == 'Accept, Accept-Encoding'
+    assert 'public' in response['Cache-Control']
+
+
+def test_versioned_lru_cache():
+    lru = utils.VersionedLRUCache(10)
+    lru.set('a', '1', b'aaaa')
+    lru.set('b', '1', b'bbbb')
+    assert lru.get('a', '1') == b'aaaa'
+    assert lru.get('b', '2') is None
+
+    # Evicts the least recently used entry
+    lru.set('c', '1', b'cccc')
+    assert lru.get('b', '1') is None
+    assert lru.get('a', '1') == b'aaaa'
+
+    # Values larger than the cache are not stored
+    lru.set('d', '1', b'd' * 11)
+    assert lru.get('d', '1') is None
+
+    assert lru.stats() == {
+        'entries': 2,
+        'size': 8,
+        'max_size': 10,
+        'hits': 2,
+        'misses': 3,
+        'evictions': 1,
+    }
+
+
+def test_get_page_local_cache(package, platform):
+    lru = utils.VersionedLRUCache(1024 * 1024)
+    page = pages.build_page([package.index], platform, 'dist-a')
+
+    assert pages.get_page(
+        ['test'], 'platform', 'dist-a', local_cache=lru) == page
+    assert pages.get_page(
+        ['test'], 'platform', 'dist-a', local_cache=lru) == page
+    assert (lru.hits, lru.misses) == (1, 1)
+
+    package.expire_cache()
+    assert pages.get_page(
+        ['test'], 'platform', 'dist-a', local_cache=lru)[1] is None
+
+
+def test_local_cache_stats_logging(settings, package, platform):
+    lru = utils.VersionedLRUCache(1024 * 1024)
+    pages.build_page([package.index], platform, 'dist-a')
+
+    settings.PAGES_LOCAL_CACHE_STATS_INTERVAL = 3600
+    with mock.patch.object(pages.log, 'info') as info:
+        pages.get_page(['test'], 'platform', 'dist-a', local_cache=lru)
+    assert not info.called
+
+    settings.PAGES_LOCAL_CACHE_STATS_INTERVAL = 0.001
+    time.sleep(0.002)
+    with mock.patch.object(pages.log, 'info') as info:
+        pages.get_page(['test'], 'platform', 'dist-a', local_cache=lru)
+        # Logged at most once per interval
+        settings.PAGES_LOCAL_CACHE_STATS_INTERVAL = 3600
+        pages.get_page(['test'], 'platform', 'dist-a', local_cache=lru)
+    info.assert_called_once_with(mock.ANY)
+    assert 'misses=1' in info.call_args[0][0]
+
+
+def test_package_links_conditional_get(client, package, platform):
+    url = '/v1/test/platform/+simple/dist-a/'
+
+    response = client.get(url, HTTP_ACCEPT_ENCODING='gzip',
+                          secure=True)
+    assert response.status_code == 200
+    etag = response['ETag']
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, HTTP_ACCEPT_ENCODING='gzip',
+                              HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 304
+    assert response['ETag'] == etag
+    assert not queries
+
+    # Every ETag sent by the client is considered
+    response = client.get(url, HTTP_ACCEPT_ENCODING='gzip',
+                          HTTP_IF_NONE_MATCH='"other", ' + etag, secure=True)
+    assert response.status_code == 304
+
+    # The uncompressed representation has a different ETag
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+    package.expire_cache()
+    response = client.get(url, HTTP_ACCEPT_ENCODING='gzip',
+                          HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 200
+    assert response['ETag'] != etag
+
+
+def test_conditional_get_missing_target(client, package, platform):
+    # A client can guess the ETag of a page which does not exist, as long as
+    # nothing was stored for it the request is not answered with a 304.
+    version = pages.get_page(['test'], 'platform', 'dist-missing')[0]
+    etag = pages.get_etag(pages.PAGES_NAMESPACE, version, False)
+    response = client.get('/v1/test/platform/+simple/dist-missing/',
+                          HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 404
+
+    response = client.get('/v1/test/platform/+simple/dist-missing/',
+                          HTTP_IF_NONE_MATCH='*', secure=True)
+    assert response.status_code == 404
+
+    version = pages.get_root(['missing'])[0]
+    etag = pages.get_etag(pages.ROOT_NAMESPACE, version, False)
+    response = client.get('/v1/missing/platform/+simple/',
+                          HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 404
+
+
+def test_root_listing(client, package, platform):
+    index = package.index
+    url = '/v1/test/platform/+simple/'
+
+    response = client.get(url, secure=True)
+    assert response.status_code == 200
+    assert b'<a href="dist-a/">dist-a</a>' in response.content
+    etag = response['ETag']
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 304
+
+    # Updates to existing packages don't change the listing
+    index.update_projects(['dist-a'])
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 304
+
+    index.get_package('dist-b')
+    models.Package.objects.filter(slug='dist-a').delete()
+    with CaptureQueriesContext(connection) as queries:
+        assert index.update_projects(['dist-a', 'dist-b']) == {'dist-b'}
+    assert len(queries) == 1
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag, secure=True)
+    assert response.status_code == 200
+    assert b'dist-a' not in response.content
+    assert b'<a href="dist-b/">dist-b</a>' in response.content
+
+
+def test_negotiate_content_type():
+    factory = RequestFactory()
+
+    def negotiate(accept=None):
+        if accept is None:
+            return pages.negotiate_content_type(factory.get('/'))
+        return pages.negotiate_content_type(
+            factory.get('/', HTTP_ACCEPT=accept))
+
+    assert negotiate() == pages.HTML_CONTENT_TYPE
+    assert negotiate('text/html') == pages.HTML_CONTENT_TYPE
+    assert negotiate('application/json') == pages.HTML_CONTENT_TYPE
+    assert negotiate(
+        'application/vnd.pypi.simple.v1+json, '
+        'application/vnd.pypi.simple.v1+html; q=0.2, '
+        'text/html; q=0.01'
+    ) == pages.JSON_CONTENT_TYPE
+    assert negotiate(
+        'application/vnd.pypi.simple.v1+json; q=0.1, text/html'
+    ) == pages.HTML_CONTENT_TYPE
+
+
+def test_json_simple_api(client, package, platform):
+    url = '/v1/test/platform/+simple/dist-a/'
+    accept = 'application/vnd.pypi.simple.v1+json'
+
+    html = client.get(url, secure=True)
+    response = client.get(url, HTTP_ACCEPT=accept, secure=True)
+    assert response.status_code == 200
+    assert response['Content-Type'] == pages.JSON_CONTENT_TYPE
+    assert response['ETag'] != html['ETag']
+
+    page = json.loads(response.content.decode('utf-8'))
+    assert page['meta'] == {'api-version': '1.0'}
+    assert page['name'] == 'dist-a'
+    assert len(page['files']) == 20
+    assert page['files'][0]['filename'] == 'dist-a-1.9.tar.gz'
+
+    # Both variants are cached separately
+    response = client.get(url, HTTP_ACCEPT=accept,
+                          HTTP_IF_NONE_MATCH=response['ETag'], secure=True)
+    assert response.status_code == 304
+    response = client.get(url, secure=True)
+    assert response.content == html.content
+
+    response = client.get('/v1/test/platform/+simple/', HTTP_ACCEPT=accept,
+                          secure=True)
+    assert json.loads(response.content.decode('utf-8'))['projects'] == [
+        {'name': 'dist-a'},
+    ]
+
+
+def test_metadata_file(client, settings, package, platform):
+    settings.ALWAYS_REDIRECT_DOWNLOADS = True
+    release = package.release_set.get(version='1.0')
+    build = release.get_build(platform)
+    build.build.name = 'dist_a-1.0-py3-none-any.whl'
+    build.metadata_sha256 = 'a' * 64
+    build.save()
+
+    _, content = pages.build_page([package.index], platform, 'dist-a')
+    page = gzip.decompress(content).decode('utf-8')
+    assert page.count('data-dist-info-metadata="sha256={}"'.format(
+        'a' * 64)) == 1
+    assert page.count('data-core-metadata') == 1
+
+    _, content = pages.build_page([package.index], platform, 'dist-a',
+                                  namespace=pages.PAGES_JSON_NAMESPACE)
+    files = json.loads(gzip.decompress(content).decode('utf-8'))['files']
+    metadata = [f['core-metadata'] for f in files if 'core-metadata' in f]
+    assert metadata == [{'sha256': 'a' * 64}]
+
+    url = build.get_absolute_url() + '.metadata'
+    with mock.patch.object(models.Build, 'get_metadata_file_url',
+                           return_value='https://files.example.com/META'):
+        response = client.get(url, secure=True)
+    assert response.status_code == 302
+    assert response['Location'] == 'https://files.example.com/META'
+
+    build.metadata_sha256 = ''
+    build.save()
+    assert client.get(url, secure=True).status_code == 404
+
+
+def test_compilation_previous(package, platform):
+    other_index = models.BackingIndex.objects.create(
+        slug='other', url='https://example.com')
+
+    def compiled(index_slugs):
+        return models.CompiledRequirements.objects.create(
+            platform=platform, requirements='dist-a',
+            index_slugs=index_slugs)
+
+    same = compiled(['test'])
+    other = compiled([other_index.slug])
+
+    def get_previous(compiled):
+        view = views.RequirementsCompilationView()
+        view.request = RequestFactory().get(
+            '/', {'previous': compiled.pk} if compiled else {})
+        view.kwargs = {'index_slugs': 'test', 'platform_slug': 'platform'}
+        return view.get_previous()
+
+    assert get_previous(same) == same
+    # Compilations against other indexes are not reused
+    assert get_previous(other) is None
+    assert get_previous(None) is None
@@ -0,0 +1,139 @@
+import json
+
+import mock
+import pytest
+
+from celery_app import utils
+from wheelsproxy import models
+from wheelsproxy.management.commands import sync_index
+
+
+class FakeResult(object):
+    def __init__(self, value, polls):
+        self.value = value
+        self.polls = polls
+
+    def ready(self):
+        self.polls -= 1
+        return self.polls < 0
+
+    def get(self):
+        return self.value
+
+
+class FakeTask(object):
+    """
+    Records the arguments of each submitted task, which completes after the
+    number of polls returned by `latency(*args)` and returns `func(*args)`.
+    """
+
+    def __init__(self, func, latency=lambda *args: 0):
+        self.func = func
+        self.latency = latency
+        self.submitted = []
+
+    def delay(self, *args):
+        self.submitted.append(args)
+        return FakeResult(self.func(*args), self.latency(*args))
+
+
+def test_unordered_submitter():
+    task = FakeTask(lambda value: value * 2,
+                    latency=lambda value: 5 if value == 1 else 0)
+    results = utils.unordered_submitter(
+        task, 2, iter([(1,), (2,), (3,), (4,)]), poll_interval=0)
+
+    assert next(results)[:2] == ((2,), 4)
+    # Only the slot freed by the completed task was refilled
+    assert task.submitted == [(1,), (2,), (3,)]
+
+    # The slow task does not hold back the ones submitted after it
+    assert [args for args, res, duration in results] == [(3,), (4,), (1,)]
+
+
+def test_adaptive_chunker():
+    chunker = utils.AdaptiveChunker(
+        10, target_duration=60, min_size=2, max_size=50, smoothing=0.5)
+    chunks = chunker.iter_chunks(range(200))
+    assert len(next(chunks)) == 10
+
+    # 10 items in 20s: 2s per item, 30 items fit in the target duration
+    chunker.record(10, 20)
+    assert len(next(chunks)) == 30
+
+    # Latency is smoothed: (0.5 * 0.5 + 0.5 * 2) = 1.25s per item
+    chunker.record(30, 15)
+    assert chunker.size == 48
+
+    chunker.record(10, 0)
+    assert chunker.size == 50
+    chunker.record(1, 3600)
+    assert chunker.size == 2
+
+    # Empty chunks are not recorded
+    chunker.record(0, 10)
+    assert chunker.size == 2
+
+
+@pytest.mark.django_db
+def test_sync_index_resumes_from_checkpoint(tmpdir):
+    index = models.BackingIndex.objects.create(
+        slug='test', url='https://example.com', last_update_serial=1)
+    dist_a = index.get_package('dist-a')
+    index.get_package('dist-b')
+
+    checkpoint = tmpdir.join('checkpoint')
+    checkpoint.write(
+        json.dumps({'serial': 42}) + '\n' +
+        json.dumps({'succeded': {'dist-a': dist_a.pk},
+                    'ignored': ['dist-x']}) + '\n'
+    )
+
+    fake_client = mock.Mock()
+    fake_client.changelog_last_serial.return_value = 42
+    fake_client.list_packages.return_value = [
+        'dist-a', 'dist-c', 'dist-x', 'dist-d']
+
+    def import_packages(index_id, package_names):
+        return {name: index.get_package(name).pk
+                for name in package_names}, [], {}
+
+    task = FakeTask(import_packages)
+    with mock.patch.object(models.BackingIndex, 'client', fake_client), \
+            mock.patch.object(sync_index, 'import_packages', task):
+        sync_index.command.main(
+            ['--initial', '--checkpoint', str(checkpoint), 'test'],
+            standalone_mode=False,
+        )
+
+    # Only the packages not recorded in the checkpoint were imported
+    assert task.submitted == [(index.pk, ['dist-c', 'dist-d'])]
+    assert not checkpoint.exists()
+
+    index.refresh_from_db()
+    assert index.last_update_serial == 42
+    fake_client.changelog_last_serial.assert_called_once_with()
+    assert sorted(index.package_set.values_list('slug', flat=True)) == [
+        'dist-a', 'dist-c', 'dist-d']
+
+
+@pytest.mark.django_db
+def test_sync_index_concurrency_after_initial_sync():
+    models.BackingIndex.objects.create(slug='test', url='https://example.com')
+
+    fake_client = mock.Mock()
+    # Updates happened while the initial sync was running
+    fake_client.changelog_last_serial.side_effect = [10, 12]
+    fake_client.list_packages.return_value = []
+
+    with mock.patch.object(models.BackingIndex, 'client', fake_client), \
+            mock.patch.object(sync_index, 'import_packages', FakeTask(None)), \
+            mock.patch.object(models.BackingIndex, 'itersync',
+                              return_value=iter([11, 12])) as itersync:
+        sync_index.command.main(
+            ['--initial', '--concurrency', '4', 'test'],
+            standalone_mode=False,
+        )
+
+    # The task concurrency of the initial sync does not leak into itersync
+    itersync.assert_called_once_with(concurrency=4)
@@ -1,6 +1,6 @@
 from django.conf.urls import include, url
 from django.conf import settings
-from django.views import static, generic
+from django.views import static
 
 from . import views, storage
 
@@ -14,7 +14,7 @@ urlpatterns = [
     url(r'^v1/(?P<index_slugs>[a-z0-9\+-]+)/(?P<platform_slug>[a-z0-9-]+)/', include([  # NOQA
         url(
             r'^\+simple/$',
-            generic.TemplateView.as_view(template_name='root.html'),
+            views.IndexRoot.as_view(),
             name='index_root',
         ),
 
@@ -25,6 +25,13 @@ urlpatterns = [
             name='package_links',
         ),
 
+        # Wheel metadata (PEP 658)
+        url(
+            r'^\+simple/(?P<package_name>[^/]+)/(?P<version>[^/]+)/download/(?P<build_id>\d+)/(?P<filename>[^/]+)\.metadata$',  # NOQA
+            views.BuildMetadata.as_view(),
+            name='download_build_metadata',
+        ),
+
         # Download redirects
         url(
             r'^\+simple/(?P<package_name>[^/]+)/(?P<version>[^/]+)/download/(?P<build_id>\d+)/(?P<filename>[^/]+)$',  # NOQA
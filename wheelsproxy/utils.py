@@ -1,9 +1,15 @@
 import re
+import time
 import random
+import posixpath
+import functools
+import threading
+import collections
 
 import furl
 
 from pkg_resources import Requirement, yield_lines, safe_version
+from pkg_resources.extern.packaging.markers import Marker
 
 
 REQ_REGEXES = [
@@ -24,10 +30,69 @@ def parse_requirement(s):
     return Requirement.parse(''.join(match.groups(default='')))
 
 
+@functools.lru_cache(maxsize=16384)
+def parse_requirement_spec(spec):
+    """
+    Parses a PEP 508 requirement string. Results are shared between the
+    callers and must not be modified.
+    """
+    return Requirement.parse(spec)
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_marker(marker):
+    return Marker(marker)
+
+
 def normalize_package_name(package_name):
     return re.sub(r'(\.|-|_)+', '-', package_name.lower())
 
 
+WHEEL_FILENAME_RE = re.compile(
+    r'^(?P<name>[^-]+)-(?P<version>[^-]+)(?:-(?P<build>\d[^-]*))?'
+    r'-(?P<python>[^-]+)-(?P<abi>[^-]+)-(?P<platform>[^-]+)\.whl$'
+)
+
+PYTHON_IMPLEMENTATION_TAGS = {
+    'cpython': 'cp',
+    'pypy': 'pp',
+    'ironpython': 'ip',
+    'jython': 'jy',
+}
+
+
+def get_python_tags(environment):
+    """
+    Returns the python tags of the ``none-any`` wheels installable on the
+    interpreter described by the given marker environment.
+    """
+    major, minor = environment['python_version'].split('.')[:2]
+    tags = {'py' + major}
+    tags.update('py{}{}'.format(major, i) for i in range(int(minor) + 1))
+    implementation = PYTHON_IMPLEMENTATION_TAGS.get(
+        environment.get('implementation_name'))
+    if implementation:
+        tags.add(implementation + major + minor)
+    return tags
+
+
+def is_pure_wheel(url, environment):
+    """
+    Returns whether the given URL points to a wheel which can be installed
+    as-is (``none-any``) on any platform running the interpreter described
+    by the given marker environment. Always false if the environment is not
+    known.
+    """
+    filename = posixpath.basename(str(furl.furl(url).path))
+    match = WHEEL_FILENAME_RE.match(filename)
+    if not match or not environment:
+        return False
+    if match.group('abi') != 'none' or match.group('platform') != 'any':
+        return False
+    python_tags = set(match.group('python').split('.'))
+    return bool(python_tags & get_python_tags(environment))
+
+
 def normalize_version(version):
     return safe_version(version)
 
@@ -47,6 +112,81 @@ class UniquesIterator(object):
     __call__ = not_seen_yet
 
 
+class VersionedLRUCache(object):
+    """
+    Thread-safe LRU cache bounded by the total size of its values. Every
+    value is stored along with a version, and is only returned if the
+    requested version matches.
+    """
+
+    def __init__(self, max_size, sizeof=len):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats_reported_at = time.monotonic()
+
+    def get_version(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry[0] if entry else None
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, version, value):
+        size = self.sizeof(value)
+        with self._lock:
+            self._discard(key)
+            if size > self.max_size:
+                return
+            self._entries[key] = (version, value)
+            self.size += size
+            while self.size > self.max_size:
+                key, (version, value) = self._entries.popitem(last=False)
+                self.size -= self.sizeof(value)
+                self.evictions += 1
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= self.sizeof(entry[1])
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'size': self.size,
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def stats_if_due(self, interval):
+        """
+        Returns the statistics of the cache if they were not returned by
+        this method during the last `interval` seconds, ``None`` otherwise.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._stats_reported_at < interval:
+                return None
+            self._stats_reported_at = now
+        return self.stats()
+
+
 def split_requirements(strs):
     """Yield ``Requirement`` objects for each specification in `strs`
     `strs` must be a string, or a (possibly-nested) iterable thereof.
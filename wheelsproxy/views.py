@@ -1,5 +1,3 @@
-import six
-
 from django.db import transaction
 from django.http import (
     Http404,
@@ -7,12 +5,10 @@ from django.http import (
     HttpResponseBadRequest,
     UnreadablePostError,
 )
-from django.core.cache import cache as cache_backend
-from django.core.cache.backends import dummy
 from django.core.urlresolvers import reverse
+from django.utils.cache import add_never_cache_headers
 from django.utils.text import slugify
-from django.views.generic import RedirectView, TemplateView, View
-from django.views.decorators import gzip
+from django.views.generic import RedirectView, View
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.functional import cached_property
 from django.utils.decorators import method_decorator
@@ -20,7 +16,7 @@ from django.shortcuts import get_object_or_404, redirect
 
 from pkg_resources import Requirement, RequirementParseError
 
-from . import models, utils, tasks
+from . import models, pages, utils, tasks
 
 
 class PackageViewMixin(object):
@@ -46,85 +42,121 @@ class PackageViewMixin(object):
         )
 
 
-class PackageLinks(PackageViewMixin, TemplateView):
-    template_name = 'wheelsproxy/simple.html'
+class SimpleAPIMixin(object):
+    """
+    Serves the HTML or the JSON variant of a simple API page, depending on
+    the content type negotiated with the client.
+    """
+    html_namespace = None
+    json_namespace = None
+
+    @cached_property
+    def content_type(self):
+        return pages.negotiate_content_type(self.request)
+
+    @cached_property
+    def namespace(self):
+        if self.content_type == pages.JSON_CONTENT_TYPE:
+            return self.json_namespace
+        else:
+            return self.html_namespace
+
+    @cached_property
+    def client_versions(self):
+        return pages.get_client_versions(self.request, self.namespace)
+
+    def not_modified_response(self, version):
+        return pages.not_modified_response(
+            self.request, self.namespace, version)
+
+    def page_response(self, content, version):
+        return pages.page_response(
+            self.request, content, version,
+            namespace=self.namespace,
+            content_type=self.content_type,
+        )
+
 
-    def get_cache_backend(self):
-        cache = True
+class PackageLinks(SimpleAPIMixin, PackageViewMixin, View):
+    html_namespace = pages.PAGES_NAMESPACE
+    json_namespace = pages.PAGES_JSON_NAMESPACE
 
+    def use_cache(self):
         if self.package_name != self.kwargs['package_name']:
-            cache = False
+            return False
 
         if self.request.GET.get('cache') == 'off':
-            cache = False
-
-        if cache:
-            return cache_backend
-        else:
-            return dummy.DummyCache(host=None, params={})
+            return False
 
-    def cache_key(self):
-        index_slugs = self.kwargs['index_slugs'].split('+')
-        return models.Package.get_cache_key(
-            'links',
-            [slugify(slug) for slug in index_slugs],
-            slugify(self.kwargs['platform_slug']),
-            self.package_name,
-        )
+        return True
 
-    @method_decorator(gzip.gzip_page)
     def get(self, request, *args, **kwargs):
-        cache = self.get_cache_backend()
-        cache_key = self.cache_key()
-        response = cache.get(cache_key)
-        if not response:
+        use_cache = self.use_cache()
+
+        if use_cache:
+            index_slugs = self.kwargs['index_slugs'].split('+')
+            version, content = pages.get_page(
+                [slugify(slug) for slug in index_slugs],
+                slugify(self.kwargs['platform_slug']),
+                self.package_name,
+                client_versions=self.client_versions,
+                namespace=self.namespace,
+            )
+            if content is pages.NOT_MODIFIED:
+                return self.not_modified_response(version)
+            if content is not None:
+                return self.page_response(content, version)
+
+        # Ensure package names are canonicalized
+        if self.package_name != self.kwargs['package_name']:
             # Ensure at least one package exists in the index set
-            for index in self.indexes:
-                if index.package_set.filter(slug=self.package_name).exists():
-                    break
-            else:
+            packages = models.Package.objects.filter(
+                index__in=self.indexes,
+                slug=self.package_name,
+            )
+            if not packages.exists():
                 raise Http404('Package not found')
 
-            # Ensure package names are canonicalized
-            if self.package_name != self.kwargs['package_name']:
-                return redirect(
-                    'wheelsproxy:package_links', permanent=True,
-                    index_slugs=self.kwargs['index_slugs'],
-                    platform_slug=self.kwargs['platform_slug'],
-                    package_name=self.package_name,
-                )
-
-            # Render the normal response
-            response = super(PackageLinks, self).get(request, *args, **kwargs)
-            if hasattr(response, 'render') and six.callable(response.render):
-                response.render()
-            cache.set(cache_key, response, timeout=None)
-        return response
+            return redirect(
+                'wheelsproxy:package_links', permanent=True,
+                index_slugs=self.kwargs['index_slugs'],
+                platform_slug=self.kwargs['platform_slug'],
+                package_name=self.package_name,
+            )
 
-    def get_context_data(self, **kwargs):
-        context = super(PackageLinks, self).get_context_data(**kwargs)
-        context['package_name'] = self.package_name
-        context['platform'] = self.platform
-        context['links'] = self.get_links()
-        return context
+        version, content = pages.build_page(
+            self.indexes,
+            self.platform,
+            self.package_name,
+            store=use_cache,
+            namespace=self.namespace,
+        )
+        if content is None:
+            raise Http404('Package not found')
 
-    def get_links(self):
-        unique_builds = utils.UniquesIterator(lambda b: b.release.version)
+        response = self.page_response(content, version)
+        if not use_cache:
+            add_never_cache_headers(response)
+        return response
 
-        links = []
 
-        for index in self.indexes:
-            try:
-                package = index.package_set.get(slug=self.package_name)
-            except models.Package.DoesNotExist:
-                package = None
-                builds = []
-            else:
-                builds = package.get_builds(self.platform)
-                builds = unique_builds(builds)
-            links.append((index, package, builds))
+class IndexRoot(SimpleAPIMixin, PackageViewMixin, View):
+    html_namespace = pages.ROOT_NAMESPACE
+    json_namespace = pages.ROOT_JSON_NAMESPACE
 
-        return links
+    def get(self, request, *args, **kwargs):
+        index_slugs = self.kwargs['index_slugs'].split('+')
+        version, content = pages.get_root(
+            [slugify(slug) for slug in index_slugs],
+            client_versions=self.client_versions,
+            namespace=self.namespace,
+        )
+        if content is pages.NOT_MODIFIED:
+            return self.not_modified_response(version)
+        if content is None:
+            version, content = pages.build_root(
+                self.indexes, namespace=self.namespace)
+        return self.page_response(content, version)
 
 
 class BuildTrigger(PackageViewMixin, RedirectView):
@@ -153,6 +185,16 @@ class BuildTrigger(PackageViewMixin, RedirectView):
         return self.build.get_build_url(build_if_needed=True)
 
 
+class BuildMetadata(RedirectView):
+    permanent = False
+
+    def get_redirect_url(self, *args, **kwargs):
+        build = get_object_or_404(models.Build, pk=self.kwargs['build_id'])
+        if not build.has_metadata_file():
+            raise Http404('Metadata not available')
+        return build.get_metadata_file_url()
+
+
 class RequirementsProcessingMixin(object):
     @method_decorator(csrf_exempt)
     @method_decorator(transaction.non_atomic_requests)
@@ -173,6 +215,31 @@ class RequirementsProcessingMixin(object):
 class RequirementsCompilationView(RequirementsProcessingMixin,
                                   PackageViewMixin,
                                   View):
+    def get_previous(self):
+        """
+        Returns the compilation referenced by the ``previous`` query
+        parameter, whose pins are kept when still compatible. Only
+        compilations for the same platform and indexes are considered.
+        """
+        try:
+            return models.CompiledRequirements.objects.get(
+                pk=int(self.request.GET['previous']),
+                platform=self.platform,
+                index_slugs=[i.slug for i in self.indexes],
+            )
+        except (KeyError, ValueError,
+                models.CompiledRequirements.DoesNotExist):
+            return None
+
+    def compiled_response(self, reqs):
+        response = HttpResponse(
+            reqs.pip_compiled_requirements,
+            content_type='text/plain',
+        )
+        # Passed back as ?previous= to recompile incrementally
+        response['X-Compilation-Id'] = str(reqs.pk)
+        return response
+
     def process_body(self, body):
         index_url = self.request.build_absolute_uri(
             reverse('wheelsproxy:index_root', kwargs={
@@ -180,20 +247,30 @@ class RequirementsCompilationView(RequirementsProcessingMixin,
                 'platform_slug': self.kwargs['platform_slug'],
             }),
         )
+        index_slugs = [i.slug for i in self.indexes]
+        requirements = body
+        if isinstance(requirements, bytes):
+            requirements = requirements.decode('utf-8')
+
+        cached = models.CompiledRequirements.objects.get_cached(
+            self.platform, index_slugs, requirements)
+        if cached is not None:
+            return self.compiled_response(cached)
+
         reqs = models.CompiledRequirements.objects.create(
             platform=self.platform,
-            requirements=body,
+            requirements=requirements,
             index_url=index_url,
-            index_slugs=[i.slug for i in self.indexes],
+            index_slugs=index_slugs,
+            input_hash=models.CompiledRequirements.get_input_hash(
+                self.platform, index_slugs, requirements),
+            previous=self.get_previous(),
         )
         tasks.internal_compile.delay(reqs.pk)
         tasks.pip_compile.delay(reqs.pk).get(propagate=False)
         reqs = models.CompiledRequirements.objects.get(pk=reqs.pk)
         if reqs.is_compiled():
-            return HttpResponse(
-                reqs.pip_compiled_requirements,
-                content_type='text/plain',
-            )
+            return self.compiled_response(reqs)
         else:
             return HttpResponseBadRequest(
                 reqs.pip_compilation_log,